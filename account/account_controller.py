@@ -1,7 +1,7 @@
 import math
 import os
 from pathlib import Path
-from typing import List
+from typing import List, Union
 
 from PyQt5.QtCore import QFileInfo
 
@@ -12,6 +12,8 @@ from util import log
 from util.app_decrypter import AppDecrypter
 from util.app_injector import AppInjector
 from util.app_serializer import AppSerializer
+from util.decrypt_channel import DecryptedFileChannel
+from util.output_generation import OutputGeneration
 from util.cpp_lib import CppLibrary
 from util.tools import WinTool
 from widget.custom_msgbox import CustomMsgBox
@@ -20,6 +22,7 @@ from widget.custom_msgbox import CustomMsgBox
 class AccountController:
     currentPage = 1
     dataType = -1
+    decryptWorkers = 1  # 同时解密的备份文件数，1为依次解密
 
     def __init__(self, accountWidget: AccountWidget):
         self.accountWidget = accountWidget
@@ -186,12 +189,29 @@ class AccountController:
     def decrypt_and_serialize(self, i, account: Account):
 
         dbUtil = DBUtil(autoClose=False)
+        # 增量导出：沿用上次导出的用户文件，只同步变化的用户文件
+        incremental = self.__isSettingEnabled(dbUtil, DBUtil.SETTINGS_INCREMENTAL_EXPORT)
+        # 流式导出：解密开始时同时开始序列化，序列化线程等待需要的文件解密完成
+        streaming = self.__isSettingEnabled(dbUtil, DBUtil.SETTINGS_STREAMING_EXPORT)
+        channel = DecryptedFileChannel() if streaming else None
+        generation: Union[OutputGeneration, None] = None  # 本次导出写入的代目录
 
         def serializeCallback(isFinished, msg):
             self.accountWidget.showMsgSignal.emit(0 if isFinished else 2, msg)
 
+        def startSerialize():
+            ae = AppSerializer.getInstance(account)
+            ae.incrementalSync = incremental
+            ae.decryptChannel = channel
+            ae.outputGeneration = generation
+            ae.serialize(serializeCallback, self.accountWidget)
+
         # 主线程
         def decryptCallback(statusList: List):  # [dbStatus, dbMsg, backupStatus, backupMsg]
+            # 不进行序列化时删除代目录，保留上一次的导出；流式导出时由序列化线程删除
+            if channel is None and not (len(statusList) == 4 and statusList[0] and statusList[2]):
+                generation.discard()
+
             if len(statusList) != 4:
                 CustomMsgBox.showMsg("激活失败。", CustomMsgBox.ICON_QUESTION)
                 return
@@ -219,8 +239,9 @@ class AccountController:
             else:
                 if bakStatus:
                     log.i(message)
-                    ae = AppSerializer.getInstance(account)
-                    ae.serialize(serializeCallback, self.accountWidget)
+                    # 流式导出时序列化已经开始
+                    if channel is None:
+                        startSerialize()
                 else:
                     CustomMsgBox.showMsg(message, CustomMsgBox.ICON_QUESTION if errorOccurred else CustomMsgBox.ICON_OK)
 
@@ -231,9 +252,18 @@ class AccountController:
         else:
             CustomMsgBox.showStatus("正在解密...")
             outputPath = self.__getOutputPath(account, dbUtil)
+            generation = OutputGeneration(outputPath, account.uid, incremental)
 
             # decryptCallback([True, "", True, ""])
-            AppDecrypter.decrypt(account, outputPath, decryptCallback, self.accountWidget, self.showMsgCallback)
+            AppDecrypter.decrypt(account, outputPath, decryptCallback, self.accountWidget, self.showMsgCallback,
+                                 incremental, channel, self.decryptWorkers, generation)
+            if channel is not None:
+                startSerialize()
+
+    @staticmethod
+    def __isSettingEnabled(dbUtil, settingType: int) -> bool:
+        res, setting = dbUtil.exec(DBUtil.SQL_QUERY_SETTING_BY_TYPE, settingType)
+        return res and str(setting[0][0]) == "1"
 
     @staticmethod
     def __getOutputPath(account, dbUtil):
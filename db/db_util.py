@@ -1,3 +1,12 @@
+import itertools
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+import weakref
+from typing import Iterator, Iterable, List, Dict, Set, Union
+
 from PyQt5.QtSql import QSqlDatabase, QSqlQuery
 
 from util import log
@@ -5,6 +14,51 @@ from util.tools import MD5Tool
 
 DEFAULT_DB = "./default.db"
 
+# 只读扫描已解密数据库时使用：1G的mmap、256M的页缓存、临时表放在内存中
+READ_ONLY_PRAGMA_LIST = [
+    "pragma mmap_size = 1073741824",
+    "pragma cache_size = -262144",
+    "pragma temp_store = memory"
+]
+
+
+def batchRows(rowIter: Iterable, batchSize: int) -> Iterator:
+    """
+    batchSize大于0时，把逐行的迭代器变为每次返回最多batchSize行列表的迭代器
+    """
+    if batchSize <= 0:
+        yield from rowIter
+        return
+
+    batch = []
+    for row in rowIter:
+        batch.append(row)
+        if len(batch) == batchSize:
+            yield batch
+            batch = []
+    if len(batch) != 0:
+        yield batch
+
+
+class _ThreadConnections:
+    """
+    一个线程创建的连接。线程结束时threading.local释放该对象，随即移除其中的连接及已prepare的查询，
+    避免每个短时间运行的QThread都留下一个打开的连接
+    """
+
+    def __init__(self):
+        self.connectionDict: Dict[str, str] = {}  # {数据库绝对路径: 连接名}
+        finalizer = weakref.finalize(self, _removeConnections, self.connectionDict)
+        finalizer.atexit = False  # 退出时Qt可能已经析构，不再移除
+
+
+def _removeConnections(connectionDict: Dict[str, str]):
+    for connectionName in connectionDict.values():
+        # 先释放QSqlQuery，否则removeDatabase会提示连接仍在使用
+        DBUtil._queryCacheDict.pop(connectionName, None)
+        QSqlDatabase.removeDatabase(connectionName)
+    connectionDict.clear()
+
 
 class DBUtil:
     SQL_CREATE_USER = """
@@ -76,18 +130,57 @@ class DBUtil:
     SQL_ADD_SETTINGS = "insert into settings values (?, ?)"
     SQL_QUERY_SETTINGS = "select * from settings"
     SQL_UPDATE_STORAGE = "update settings set path = ? where type = ?"
+    SQL_QUERY_SETTING_BY_TYPE = "select path from settings where type = ?"
+
+    SETTINGS_INCREMENTAL_EXPORT = 4  # settings表中保存增量导出开关的行，path为"1"时开启
+    SETTINGS_STREAMING_EXPORT = 5  # settings表中保存流式导出开关的行，path为"1"时开启
 
     SQL_ADD_APP_INSTALL_PATH = "insert into app_install values (?, ?)"
     SQL_DELETE_APP_INSTALL_PATH = "delete from app_install where type = ?"
     SQL_GET_APP_INSTALL_PATH = "select * from app_install where type = ?"
 
-    def __init__(self, dbName: str = DEFAULT_DB, autoClose=True):
-        self.dbName = dbName
-        self.autoClose = autoClose
-        self.db = QSqlDatabase.addDatabase("QSQLITE", dbName)
-        self.db.setDatabaseName(dbName)
+    # 连接按数据库路径和线程缓存：QSqlDatabase的连接只能在创建它的线程中使用
+    _threadLocal = threading.local()  # _threadLocal.holder: 当前线程的_ThreadConnections
+    _connectionCounter = itertools.count()
+    _queryCacheDict: Dict[str, Dict[str, QSqlQuery]] = {}  # {连接名: {sql: 已prepare的查询}}
+    _initializedDbSet: Set[str] = set()  # 已经检查过表结构的数据库
+    _initLock = threading.RLock()
 
-        self.__initDb()
+    def __init__(self, dbName: str = DEFAULT_DB, autoClose=True, readOnly=False):
+        """
+        :param autoClose: 每次exec后是否关闭连接。应用数据库(default.db)的连接始终保持打开。
+        :param readOnly: 以只读方式打开已解密的数据库，不创建应用的表，并使用READ_ONLY_PRAGMA_LIST
+        """
+        self.dbName = dbName
+        self.readOnly = readOnly
+        dbPath = os.path.abspath(dbName)
+        self.isAppDb = dbPath == os.path.abspath(DEFAULT_DB)
+        self.autoClose = autoClose and not self.isAppDb
+        if readOnly:
+            dbPath += "?ro"  # 只读连接与读写连接分开缓存
+
+        holder: Union[_ThreadConnections, None] = getattr(DBUtil._threadLocal, "holder", None)
+        if holder is None:
+            holder = DBUtil._threadLocal.holder = _ThreadConnections()
+        connectionDict = holder.connectionDict
+
+        if dbPath not in connectionDict:
+            connectionName = f"{dbPath}#{next(DBUtil._connectionCounter)}"
+            db = QSqlDatabase.addDatabase("QSQLITE", connectionName)
+            db.setDatabaseName(dbName)
+            if readOnly:
+                db.setConnectOptions("QSQLITE_OPEN_READONLY")
+            connectionDict[dbPath] = connectionName
+        self.connectionName = connectionDict[dbPath]
+        self.db = QSqlDatabase.database(self.connectionName, False)
+
+        if readOnly:
+            return
+
+        with DBUtil._initLock:
+            if dbPath not in DBUtil._initializedDbSet:
+                self.__initDb()
+                DBUtil._initializedDbSet.add(dbPath)
 
     def __initDb(self):
         res = self.exec(self.SQL_CHECK_IF_TABLE_EXISTS, "user", needResult=False)
@@ -107,6 +200,12 @@ class DBUtil:
             self.exec(self.SQL_ADD_SETTINGS, 2, "")
             self.exec(self.SQL_ADD_SETTINGS, 3, "%USERPROFILE%")
 
+        # 旧版本创建的settings表没有增量导出、流式导出开关
+        for settingType in (self.SETTINGS_INCREMENTAL_EXPORT, self.SETTINGS_STREAMING_EXPORT):
+            res = self.exec(self.SQL_QUERY_SETTING_BY_TYPE, settingType, needResult=False)
+            if len(res) == 0:
+                self.exec(self.SQL_ADD_SETTINGS, settingType, "0")
+
         res = self.exec(self.SQL_CHECK_IF_TABLE_EXISTS, "app_install", needResult=False)
         if not res[0][0]:
             self.exec(self.SQL_CREATE_APP_INSTALL)
@@ -114,13 +213,29 @@ class DBUtil:
     def open(self):
         if not self.db.isOpen():
             self.db.open()
+            if self.readOnly:
+                for pragma in READ_ONLY_PRAGMA_LIST:
+                    QSqlQuery(self.db).exec_(pragma)
 
     def close(self):
+        if self.isAppDb:
+            return
+        # 连接关闭后，已经prepare的查询都会失效
+        DBUtil._queryCacheDict.pop(self.connectionName, None)
         self.db.close()
 
     def getQuery(self) -> QSqlQuery:
         return QSqlQuery(self.db)
 
+    def __getPreparedQuery(self, sql: str) -> QSqlQuery:
+        queryCache = DBUtil._queryCacheDict.setdefault(self.connectionName, {})
+        query = queryCache.get(sql)
+        if query is None:
+            query = self.getQuery()
+            if query.prepare(sql):
+                queryCache[sql] = query
+        return query
+
     def exec(self, sql: str, *args, needResult=True, dictResult=False):
         """
         :param sql: .
@@ -134,10 +249,9 @@ class DBUtil:
 
         """
         self.open()
-        query = self.getQuery()
-        query.prepare(sql)
-        for arg in args:
-            query.addBindValue(arg)
+        query = self.__getPreparedQuery(sql)
+        for i, arg in enumerate(args):
+            query.bindValue(i, arg)
         execRes = query.exec_()
 
         queryResult = []
@@ -148,14 +262,15 @@ class DBUtil:
             log.e("Error:", query.lastError().text())
             return execRes, []
 
+        record = query.record()
+        columnRange = range(record.count())
+        columnNames = [record.field(i).name() for i in columnRange]
+
         while query.next():
-            row = []
-            rowDict = {}
-            for i in range(query.record().count()):
-                rowDict[query.record().field(i).name()] = query.value(i)
-                row.append(query.value(i))
+            row = [query.value(i) for i in columnRange]
             queryResult.append(row)
-            queryDictResult.append(rowDict)
+            if dictResult:
+                queryDictResult.append(dict(zip(columnNames, row)))
 
         query.finish()
 
@@ -171,6 +286,87 @@ class DBUtil:
         else:
             return resultList
 
+    def iterRows(self, sql: str, *args, batchSize=0) -> Iterator:
+        """
+        惰性执行查询，逐行返回tuple，不构造字典，也不缓存全部结果。需要的列应在sql中写明。
+        :param batchSize: 大于0时每次返回一个最多batchSize行的列表
+        """
+        self.open()
+        query = self.getQuery()
+        query.setForwardOnly(True)
+        query.prepare(sql)
+        for arg in args:
+            query.addBindValue(arg)
+
+        if not query.exec_():
+            log.e(sql, args)
+            log.e("Error:", query.lastError().text())
+            return
+
+        def rowIter():
+            columnRange = range(query.record().count())
+            while query.next():
+                yield tuple([query.value(i) for i in columnRange])
+
+        try:
+            yield from batchRows(rowIter(), batchSize)
+        finally:
+            query.finish()
+            if self.autoClose:
+                self.close()
+
+
+class SqliteReader:
+    def __init__(self, dbName: str):
+        """
+        使用标准库sqlite3读取已解密的数据库，逐行返回tuple，没有QSqlRecord的开销。
+        数据库以immutable方式打开，不会对文件产生任何写入；临时表和临时索引仍然可以创建。
+        BLOB返回bytes，而不是DBUtil中的QByteArray；无法解码的文本与QtSql一样替换为U+FFFD。
+        """
+        self.dbName = dbName
+        self.conn = sqlite3.connect(pathlib.Path(dbName).resolve().as_uri() + "?mode=ro&immutable=1", uri=True,
+                                    check_same_thread=False)
+        self.conn.text_factory = lambda b: b.decode("utf-8", "replace")
+        for pragma in READ_ONLY_PRAGMA_LIST:
+            self.conn.execute(pragma)
+
+    def iterRows(self, sql: str, *args, batchSize=0) -> Iterator:
+        """
+        :param batchSize: 大于0时每次返回一个最多batchSize行的列表
+        """
+        cursor = self.conn.execute(sql, args)
+        if batchSize <= 0:
+            yield from cursor
+            return
+
+        try:
+            while True:
+                batch = cursor.fetchmany(batchSize)
+                if len(batch) == 0:
+                    break
+                yield batch
+        finally:
+            cursor.close()
+
+    def exec(self, sql: str, *args) -> List[tuple]:
+        return self.conn.execute(sql, args).fetchall()
+
+    def createTempIndex(self, tableName: str, selectSql: str, indexColumns: List[str]) -> float:
+        """
+        源数据库是只读的，无法直接建索引：把selectSql的结果存入临时表temp.tableName，并在indexColumns上建立索引
+        :return: 耗时（秒）
+        """
+        start = time.perf_counter()
+        self.conn.execute(f"drop table if exists temp.{tableName}")
+        self.conn.execute(f"create temp table {tableName} as {selectSql}")
+        self.conn.execute(f"create index temp.{tableName}_index on {tableName}({', '.join(indexColumns)})")
+        elapsed = time.perf_counter() - start
+        log.i(f"{self.dbName} 建立临时索引{tableName}({', '.join(indexColumns)}) 耗时{elapsed:.3f}s")
+        return elapsed
+
+    def close(self):
+        self.conn.close()
+
 
 if __name__ == '__main__':
     util = DBUtil()
@@ -1,3 +1,4 @@
+import multiprocessing
 import sys
 
 from PyQt5 import QtCore
@@ -137,6 +138,9 @@ class MainWindow(QMainWindow, BaseWidget):
 
 
 if __name__ == '__main__':
+    # 打包后的程序需要支持解析聊天记录时创建的子进程
+    multiprocessing.freeze_support()
+
     def catch_exceptions(ty, value, traceback):
         """
             捕获异常，并弹窗显示
@@ -44,6 +44,20 @@ class SettingsController:
         dbUtil.exec(DBUtil.SQL_UPDATE_STORAGE, path, typ)
         self.widget.showOnFilePathChange(path, typ)
 
+    def isIncrementalExport(self) -> bool:
+        res, setting = self.dbUtil.exec(DBUtil.SQL_QUERY_SETTING_BY_TYPE, DBUtil.SETTINGS_INCREMENTAL_EXPORT)
+        return res and str(setting[0][0]) == "1"
+
+    def changeIncrementalExport(self, enabled: bool):
+        self.dbUtil.exec(DBUtil.SQL_UPDATE_STORAGE, "1" if enabled else "0", DBUtil.SETTINGS_INCREMENTAL_EXPORT)
+
+    def isStreamingExport(self) -> bool:
+        res, setting = self.dbUtil.exec(DBUtil.SQL_QUERY_SETTING_BY_TYPE, DBUtil.SETTINGS_STREAMING_EXPORT)
+        return res and str(setting[0][0]) == "1"
+
+    def changeStreamingExport(self, enabled: bool):
+        self.dbUtil.exec(DBUtil.SQL_UPDATE_STORAGE, "1" if enabled else "0", DBUtil.SETTINGS_STREAMING_EXPORT)
+
     @staticmethod
     def decodeVersionJson(versionJson) -> str:
         versionDict = {}
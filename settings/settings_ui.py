@@ -6,7 +6,7 @@ from typing import List
 
 from PyQt5.QtCore import Qt, QSize
 from PyQt5.QtWidgets import QLabel, QPushButton, QVBoxLayout, QStackedWidget, QToolButton, QListWidget, QApplication, \
-    QHBoxLayout
+    QHBoxLayout, QCheckBox
 
 from bean.beans import SocialConfig, AppTypeToName
 from util import log, app_download_info
@@ -119,6 +119,11 @@ class CommonSettingsWidget(BaseSettingsWidget):
         self.labelFilePath = QLabel()
         self.labelDes = QLabel("文件默认保存位置")
         self.btnChange = QPushButton("更改")
+        self.labelExport = QLabel("导出")
+        self.checkIncremental = QCheckBox("增量导出")
+        self.labelIncrementalDes = QLabel("保留上次导出的用户文件，只复制或解密新增及变化的文件")
+        self.checkStreaming = QCheckBox("流式导出")
+        self.labelStreamingDes = QLabel("解密的同时开始转换，已解密的备份文件可以先转换")
 
         self.__initView()
 
@@ -133,7 +138,12 @@ class CommonSettingsWidget(BaseSettingsWidget):
                 self.btnChange: "background-color:#ffffff; "
                                 "border: 1px solid #b5b5b6; "
                                 "border-radius:5px;"
-                                "font-size:15px"}
+                                "font-size:15px",
+                self.labelExport: "font-size:18px;",
+                self.checkIncremental: "font-size:16px;",
+                self.labelIncrementalDes: "color:#c0c0c0; font-size:15px",
+                self.checkStreaming: "font-size:16px;",
+                self.labelStreamingDes: "color:#c0c0c0; font-size:15px"}
 
     def __initView(self):
         UITool.setQss(self.__getQss())
@@ -142,10 +152,23 @@ class CommonSettingsWidget(BaseSettingsWidget):
 
         self.showOnFilePathChange(self.controller.getDefaultFilePath(), SocialConfig.DEFAULT)
 
+        self.checkIncremental.setChecked(self.controller.isIncrementalExport())
+        self.checkIncremental.toggled.connect(self.controller.changeIncrementalExport)
+        UITool.setCursor(Qt.PointingHandCursor, self.checkIncremental)
+
+        self.checkStreaming.setChecked(self.controller.isStreamingExport())
+        self.checkStreaming.toggled.connect(self.controller.changeStreamingExport)
+        UITool.setCursor(Qt.PointingHandCursor, self.checkStreaming)
+
         self.vBoxRoot.addWidget(self.labelFileStorage)
         self.vBoxRoot.addWidget(self.labelFilePath)
         self.vBoxRoot.addWidget(self.labelDes)
         self.vBoxRoot.addWidget(self.btnChange)
+        self.vBoxRoot.addWidget(self.labelExport)
+        self.vBoxRoot.addWidget(self.checkIncremental)
+        self.vBoxRoot.addWidget(self.labelIncrementalDes)
+        self.vBoxRoot.addWidget(self.checkStreaming)
+        self.vBoxRoot.addWidget(self.labelStreamingDes)
         self.vBoxRoot.addStretch(1)
 
     def showOnFilePathChange(self, path: str, typ: int):
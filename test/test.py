@@ -229,5 +229,471 @@ def setFileAttr():
     winreg.CloseKey(key)
 
 
+def segmentReaderBenchmark(filePath=r"D:\WeChatDecrypt\bench_BAK_0_TEXT", fileSize=4 * 1024 ** 3, segmentNum=50000):
+    import random
+    from util.tools import MappedFileReader
+
+    path = pathlib.Path(filePath)
+    if not path.exists() or path.stat().st_size != fileSize:
+        chunk = os.urandom(16 * 1024 * 1024)
+        with open(path, 'wb') as fw:
+            for _ in range(fileSize // len(chunk)):
+                fw.write(chunk)
+
+    random.seed(0)
+    segments = []
+    for _ in range(segmentNum):
+        length = random.randint(1024, 64 * 1024)
+        segments.append((random.randint(0, fileSize - length), length))
+
+    start = time.perf_counter()
+    for offset, length in segments:
+        Utility.readFile(path, offset, length)
+    readFileTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with MappedFileReader() as reader:
+        for offset, length in sorted(segments):
+            view = reader.read(path, offset, length)
+            bytes(view)
+            view.release()
+    mmapTime = time.perf_counter() - start
+
+    print(f"Utility.readFile: {readFileTime:.2f}s, MappedFileReader: {mmapTime:.2f}s, "
+          f"{readFileTime / mmapTime:.2f}x")
+
+
+def dbReadBenchmark(dbPath=r"D:\WeChatDecrypt\bench_rows.db", rowNum=1000000):
+    import sqlite3
+    from db.db_util import SqliteReader
+
+    sql = "select id, talker, time, content from msg"
+    if not os.path.exists(dbPath):
+        conn = sqlite3.connect(dbPath)
+        conn.execute("create table msg(id integer primary key, talker text, time integer, content blob)")
+        conn.executemany("insert into msg values (?, ?, ?, ?)",
+                         ((i, f"wxid_{i % 1000}", 1644997455 + i, os.urandom(64)) for i in range(rowNum)))
+        conn.commit()
+        conn.close()
+
+    dbUtil = DBUtil(dbPath, autoClose=False, readOnly=True)
+    start = time.perf_counter()
+    dbUtil.exec(sql)
+    print(f"DBUtil.exec: {rowNum / (time.perf_counter() - start):.0f} rows/s")
+
+    start = time.perf_counter()
+    for _ in dbUtil.iterRows(sql):
+        pass
+    print(f"DBUtil.iterRows: {rowNum / (time.perf_counter() - start):.0f} rows/s")
+    dbUtil.close()
+
+    reader = SqliteReader(dbPath)
+    start = time.perf_counter()
+    for _ in reader.iterRows(sql, batchSize=10000):
+        pass
+    print(f"SqliteReader.iterRows: {rowNum / (time.perf_counter() - start):.0f} rows/s")
+    reader.close()
+
+
+def tempIndexBenchmark(backupDbPath=r"D:\WeChatDecrypt\wxid_8rmcj0zs9itk22\decrypt_Backup.db"):
+    from db.db_util import SqliteReader
+
+    reader = SqliteReader(backupDbPath)
+    start = time.perf_counter()
+    before = reader.exec("select MsgMedia.MediaId, MsgMedia.MediaIdStr, "
+                         "MsgFileSegment.Offset, MsgFileSegment.TotalLen, MsgFileSegment.FileName, MsgMedia.talker "
+                         "from MsgMedia join MsgFileSegment on MsgMedia.MediaId = MsgFileSegment.MapKey "
+                         "where MsgFileSegment.InnerOffSet = 0")
+    beforeTime = time.perf_counter() - start
+
+    indexTime = reader.createTempIndex("MediaSegment", "select MapKey, Offset, TotalLen, FileName "
+                                                       "from MsgFileSegment where InnerOffSet = 0", ["MapKey"])
+    start = time.perf_counter()
+    after = reader.exec("select MsgMedia.MediaId, MsgMedia.MediaIdStr, "
+                        "MediaSegment.Offset, MediaSegment.TotalLen, MediaSegment.FileName, MsgMedia.talker "
+                        "from MsgMedia join temp.MediaSegment on MsgMedia.MediaId = MediaSegment.MapKey")
+    afterTime = time.perf_counter() - start
+    reader.close()
+
+    print(f"before: {beforeTime:.3f}s, index: {indexTime:.3f}s, after: {afterTime:.3f}s, "
+          f"same result: {sorted(before) == sorted(after)}")
+
+
+def _varint(value):
+    result = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value == 0:
+            result.append(byte)
+            return bytes(result)
+        result.append(byte | 0x80)
+
+
+def _lengthField(fieldNo, data):
+    return _varint(fieldNo << 3 | 2) + _varint(len(data)) + data
+
+
+def _makeBlobCorpus(num):
+    """
+    按已知结构生成QQ的msgData和企业微信的content
+    :return: ([(msgData, 原文)], [(content, 原文)])
+    """
+    import random
+
+    random.seed(0)
+    wordList = ["你好", "hello", "ok", "Just", "J", "换行\n之后", "😀", "a" * 40, "长消息" * 50]
+    qqList = []
+    weComList = []
+    for _ in range(num):
+        text = " ".join(random.choice(wordList) for _ in range(random.randint(1, 6))).encode()
+        ids = b"\x08" + _varint(random.randint(2 ** 28, 2 ** 34)) + b"\x10" + _varint(random.randint(2 ** 28, 2 ** 34))
+        body = _lengthField(1, text) + _lengthField(9, b"\x08\x01") + b"\x50" + _varint(random.randint(0, 10 ** 6))
+        qqList.append((_lengthField(1, ids) + _lengthField(3, body), text))
+        weComList.append((b"\x08\x01\x12\x02ab" + _lengthField(1, text), text))
+    return qqList, weComList
+
+
+def _oldQQText(data):
+    return data[data.rfind(0x0a) + 2:data.rfind(0x4a)]
+
+
+def _oldWeComText(data):
+    return data[data.rfind(0x0a) + 1:]
+
+
+def blobDecoderBenchmark(num=1000000):
+    """
+    用按已知结构生成的msgData和content比较新旧两种截取方式，统计与原文不一致的条数
+    """
+    import unicodedata
+    from util.blob_decoder import TagBlobDecoder
+
+    def decode(line):
+        result = str(line, "utf-8", "ignore")
+        return "".join(ch for ch in result if unicodedata.category(ch)[0] != "C")
+
+    qqList, weComList = _makeBlobCorpus(num)
+    caseList = [("QQ", qqList, lambda data: TagBlobDecoder.decodeQQMsg(data).text, _oldQQText),
+                ("WeCom", weComList, TagBlobDecoder.decodeWeComContent, _oldWeComText)]
+    for name, blobList, newFunc, oldFunc in caseList:
+        start = time.perf_counter()
+        newResult = [newFunc(data) for data, _ in blobList]
+        newTime = time.perf_counter() - start
+        start = time.perf_counter()
+        oldResult = [oldFunc(data) for data, _ in blobList]
+        oldTime = time.perf_counter() - start
+
+        newWrong = sum(decode(result) != decode(text) for result, (_, text) in zip(newResult, blobList))
+        oldWrong = sum(decode(result) != decode(text) for result, (_, text) in zip(oldResult, blobList))
+        print(f"{name}: decoder {num / newTime:.0f}/s, {newWrong} wrong; "
+              f"rfind {num / oldTime:.0f}/s, {oldWrong} wrong")
+
+
+def blobDecoderGoldenTest(num=100000, qqDbPath=None, weComDbPath=None, showNum=5):
+    """
+    在同一批blob上比较新的解析结果与以前按rfind截取的结果，比较的是经过decodeUtf8后写入Json的文本。
+    生成的数据中，rfind截取正确的blob新旧结果必须相同（regression应为0），不同的只能是rfind截取错误的blob；
+    给出解密后的QQ或企业微信数据库时，再用其中的真实消息比较，列出前showNum条不同的结果供人工检查。
+    """
+    import sqlite3
+    from util.app_serializer import decodeUtf8
+    from util.blob_decoder import TagBlobDecoder
+
+    def compare(name, blobIter, newFunc, oldFunc, hasText=False):
+        total = same = regression = 0
+        diffList = []
+        for data, text in blobIter:
+            total += 1
+            newText = decodeUtf8(newFunc(data))
+            oldText = decodeUtf8(oldFunc(data))
+            if newText == oldText:
+                same += 1
+                continue
+            if hasText and oldText == decodeUtf8(text):
+                regression += 1
+            if len(diffList) < showNum:
+                diffList.append((data, oldText, newText))
+        print(f"{name}: {total}条, 与rfind相同{same}条, 不同{total - same}条"
+              + (f", regression {regression}条" if hasText else ""))
+        for data, oldText, newText in diffList:
+            print(f"    {data[:48].hex()}...\n    rfind: {oldText[:60]!r}\n    new:   {newText[:60]!r}")
+
+    qqList, weComList = _makeBlobCorpus(num)
+    compare("生成的QQ", qqList, lambda data: TagBlobDecoder.decodeQQMsg(data).text, _oldQQText, True)
+    compare("生成的企业微信", weComList, TagBlobDecoder.decodeWeComContent, _oldWeComText, True)
+
+    if qqDbPath is not None:
+        with sqlite3.connect(f"file:{qqDbPath}?mode=ro", uri=True) as conn:
+            tableList = [row[0] for row in conn.execute("select name from sqlite_master where type = 'table'")
+                         if row[0][0:3] == "msg"]
+            blobList = [(row[7], None) for tableName in tableList
+                        for row in conn.execute(f"select * from {tableName}") if row[7]]
+        compare("QQ数据库", blobList, lambda data: TagBlobDecoder.decodeQQMsg(data).text, _oldQQText)
+
+    if weComDbPath is not None:
+        with sqlite3.connect(f"file:{weComDbPath}?mode=ro", uri=True) as conn:
+            blobList = [(row[0], None) for row in conn.execute("select content from message_table")
+                        if isinstance(row[0], bytes)]
+        compare("企业微信数据库", blobList, TagBlobDecoder.decodeWeComContent, _oldWeComText)
+
+
+def chatTextDecoderBenchmark(segmentNum=2000, recordNum=200):
+    """
+    用生成的BAK_0_TEXT Segment比较按结构解析与按行猜测两种方式的速度（MB/s），并统计两者输出不一致的消息数。
+    生成的每条记录为：发送者ID、接收者ID、消息，各自是字段1，ID后跟两个varint字段，与按行猜测时假设的格式相符
+    """
+    import random
+    from util.app_serializer import WechatSerializer, WeChatMsgSegment
+
+    random.seed(0)
+    serializer = WechatSerializer(None)
+    mediaIdList = [f"{random.getrandbits(128):032x}_backup" for _ in range(100)]
+    serializer.mediaDict = dict.fromkeys(mediaIdList)
+    idList = [f"wxid_{random.getrandbits(40):010x}" for _ in range(20)] + ["filehelper", "12345678@chatroom"]
+    wordList = ["你好", "hello", "ok", "2008年", "下午见", "😀", "a" * 40, "长消息" * 20]
+
+    segmentList = []
+    for _ in range(segmentNum):
+        segment = bytearray(b"\x08\x01\x10\x02")
+        for _ in range(recordNum):
+            for weChatId in random.sample(idList, 2):
+                segment += _lengthField(1, weChatId.encode()) + b"\x10\x2a\x18\x01"
+            if random.random() < 0.1:
+                content = random.choice(mediaIdList).encode()
+            else:
+                content = " ".join(random.choice(wordList) for _ in range(random.randint(1, 5))).encode()
+            segment += _lengthField(1, content) + b"\x18\x05"
+        segmentList.append(bytes(segment))
+    totalMb = sum(len(segment) for segment in segmentList) / 1024 ** 2
+
+    resultDict = {}
+    for structuredText in (True, False):
+        serializer.structuredText = structuredText
+        msgSegment = WeChatMsgSegment(0, "0", "0", 0, 0, "", "")
+        start = time.perf_counter()
+        resultDict[structuredText] = [serializer._parseSegment(0, msgSegment, segment) for segment in segmentList]
+        print(f"structuredText={structuredText}: {totalMb / (time.perf_counter() - start):.2f} MB/s")
+
+    senderDiff = 0
+    msgDiff = 0
+    countDiff = 0
+    msgNum = 0
+    for newDict, oldDict in zip(resultDict[True], resultDict[False]):
+        newList = newDict["Messages"]
+        oldList = oldDict["Messages"]
+        msgNum += len(newList)
+        countDiff += abs(len(newList) - len(oldList))
+        for newMsg, oldMsg in zip(newList, oldList):
+            senderDiff += newMsg["Sender"] != oldMsg["Sender"]
+            if "MediaId" in newMsg:
+                msgDiff += newMsg["MediaId"] not in oldMsg["Msg"]
+            else:
+                msgDiff += "".join(newMsg["Msg"].split()) != "".join(oldMsg["Msg"].split())
+    print(f"{msgNum} messages: {senderDiff} sender differ, {msgDiff} message differ, {countDiff} missing or extra")
+
+
+def decodeUtf8Test(num=200000):
+    """
+    随机生成的bytes经过_decodeUtf8与原来逐字符调用unicodedata.category的结果必须相同，并比较两者的速度
+    """
+    import random
+    import unicodedata
+    from util.app_serializer import WechatSerializer
+
+    def decodeUtf8Old(line):
+        result = str(line, "utf-8", 'ignore')
+        return "".join(ch for ch in result if unicodedata.category(ch)[0] != "C")
+
+    def randomLine():
+        charList = []
+        for _ in range(random.randint(0, 40)):
+            kind = random.random()
+            if kind < 0.5:
+                charList.append(chr(random.randint(0x20, 0x7e)))
+            elif kind < 0.7:
+                charList.append(chr(random.randint(0x4e00, 0x9fff)))
+            elif kind < 0.8:
+                charList.append(chr(random.randint(0, 0x1f)))
+            else:
+                code = random.randint(0, sys.maxunicode)
+                charList.append(chr(code) if not 0xd800 <= code <= 0xdfff else "\ufeff")
+        line = "".join(charList).encode("utf-8")
+        # 再混入一些不合法的UTF-8字节
+        if random.random() < 0.2:
+            index = random.randint(0, len(line))
+            line = line[:index] + bytes([random.randint(0x80, 0xff)]) + line[index:]
+        return line
+
+    random.seed(0)
+    serializer = WechatSerializer(None)
+    lineList = [randomLine() for _ in range(num)]
+    mismatchList = [line for line in lineList if serializer._decodeUtf8(line) != decodeUtf8Old(line)]
+    print(f"{len(mismatchList)} mismatch in {num} random lines")
+
+    chatLineList = [random.choice(["你好", "hello world", "下午见😀", "a" * 40]).encode() +
+                    (b"\x12\x05" if random.random() < 0.3 else b"") for _ in range(num)]
+    for name, func in (("old", decodeUtf8Old), ("new", serializer._decodeUtf8)):
+        for caseName, caseList in (("random", lineList), ("chat", chatLineList)):
+            start = time.perf_counter()
+            for line in caseList:
+                func(line)
+            print(f"{name} {caseName}: {num / (time.perf_counter() - start):.0f} lines/s")
+
+
+def decryptPoolTest(fileNum=8, fileSize=16 * 1024 ** 2):
+    """
+    用PyDecryptor检查线程池解密的结果与依次解密相同，以及分块去掉文件头的结果。PyDecryptor不释放GIL，耗时只作参考
+    """
+    import shutil
+    import tempfile
+    from util.decryptor import PyDecryptor, runDecryptTasks, stripHeader
+
+    decryptor = PyDecryptor()
+    key = "0123456789abcdef"
+    rootDir = pathlib.Path(tempfile.mkdtemp())
+    backupDir = rootDir / "backup"
+    backupDir.mkdir()
+
+    plainDict = {}
+    for i in range(fileNum):
+        fileName = f"BAK_{i}_TEXT"
+        plainDict[fileName] = os.urandom(fileSize + i)
+        (rootDir / fileName).write_bytes(plainDict[fileName])
+        # 异或加密和解密是同一个操作
+        decryptor.decryptWeChatBackupFile(str(rootDir), fileName, str(rootDir), key)
+        (rootDir / f"decrypt_{fileName}").rename(backupDir / fileName)
+
+    for workers in (1, 4):
+        outputDir = rootDir / f"output_{workers}"
+        outputDir.mkdir()
+        taskList = [(fileName, lambda fileName=fileName: decryptor.decryptWeChatBackupFile(
+            str(backupDir), fileName, str(outputDir), key)) for fileName in plainDict]
+        start = time.perf_counter()
+        failure = runDecryptTasks(taskList, workers)
+        useTime = time.perf_counter() - start
+        same = all((outputDir / f"decrypt_{fileName}").read_bytes() == plain for fileName, plain in plainDict.items())
+        print(f"workers={workers}: {useTime:.2f}s, failure={failure}, same={same}")
+
+    failure = runDecryptTasks([("missing", lambda: decryptor.decryptWeChatBackupFile(
+        str(backupDir), "missing", str(rootDir), key))] + taskList, 4)
+    print(f"missing file: {failure}")
+
+    for inPlace in (True, False):
+        headerPath = rootDir / "header.db"
+        headerPath.write_bytes(bytes(1024) + plainDict["BAK_0_TEXT"])
+        throughput = stripHeader(str(headerPath), str(rootDir / "stripped.db"), inPlace=inPlace)
+        print(f"stripHeader inPlace={inPlace}: {throughput:.1f}MB/s, "
+              f"same: {(rootDir / 'stripped.db').read_bytes() == plainDict['BAK_0_TEXT']}, "
+              f"source removed: {not headerPath.exists()}")
+    shutil.rmtree(rootDir)
+
+
+def outputGenerationTest(fileNum=100000):
+    """
+    检查代目录替换后上一次的导出不被改写，以及创建代目录和替换的耗时；旧目录在后台删除
+    """
+    import shutil
+    import tempfile
+    import threading
+    from util.file_sync import SyncManifest
+    from util.output_generation import OutputGeneration
+
+    rootDir = pathlib.Path(tempfile.mkdtemp())
+    srcDir = rootDir / "src"
+    srcDir.mkdir()
+    (srcDir / "changed.txt").write_text("old")
+    (srcDir / "same.txt").write_text("same")
+
+    generation = OutputGeneration(rootDir, "uid")
+    generation.create()
+    manifest = SyncManifest(generation.path)
+    manifest.syncTree(srcDir, generation.path / "FileStorage")
+    manifest.save()
+    for i in range(fileNum):
+        (generation.path / f"{i}.json").write_bytes(b"[]")
+    print(f"commit: {generation.commit()}")
+
+    time.sleep(0.01)
+    (srcDir / "changed.txt").write_text("new")
+    generation = OutputGeneration(rootDir, "uid", incremental=True)
+    start = time.perf_counter()
+    generation.create()
+    print(f"create: {time.perf_counter() - start:.3f}s")
+    manifest = SyncManifest(generation.path)
+    manifest.syncTree(srcDir, generation.path / "FileStorage")
+    manifest.save()
+    # 序列化失败，上一次的导出不变
+    generation.discard()
+    print(f"last export intact: {(rootDir / 'uid/FileStorage/changed.txt').read_text() == 'old'}")
+
+    generation = OutputGeneration(rootDir, "uid", incremental=True)
+    generation.create()
+    manifest = SyncManifest(generation.path)
+    manifest.syncTree(srcDir, generation.path / "FileStorage")
+    manifest.save()
+    start = time.perf_counter()
+    print(f"commit: {generation.commit()}, {time.perf_counter() - start:.3f}s, "
+          f"updated: {(rootDir / 'uid/FileStorage/changed.txt').read_text() == 'new'}")
+
+    while any(thread.name.startswith("delete ") for thread in threading.enumerate()):
+        time.sleep(0.1)
+    print(f"left: {sorted(path.name for path in rootDir.iterdir())}")
+    shutil.rmtree(rootDir)
+
+
+def streamJsonOrderTest():
+    """
+    流式输出（单进程和进程池）与非流式输出的Json必须完全相同。
+    包括一个talker跨越两个BAK文件、后一个文件中的Segment的offset更小的情况，以及BAK_10_TEXT与BAK_2_TEXT
+    """
+    import shutil
+    import tempfile
+    from util.app_serializer import WechatSerializer, WeChatSession, WeChatMsgSegment
+
+    rootDir = pathlib.Path(tempfile.mkdtemp())
+    contentDict = {}  # {fileName: bytearray}
+    segmentList = []
+
+    def addSegment(talkerId, fileName, offset, text):
+        content = contentDict.setdefault(fileName, bytearray())
+        data = f"header\nwxid_sender{talkerId}\n{text}\n".encode()
+        if len(content) < offset:
+            content.extend(b"\0" * (offset - len(content)))
+        segmentList.append(WeChatMsgSegment(talkerId, "0", "0", len(content), len(data), "", fileName))
+        content.extend(data)
+
+    # 按msgSegmentList的顺序：talker 1先在BAK_0_TEXT的较大offset处，再到BAK_1_TEXT的offset 0处
+    addSegment(2, "BAK_1_TEXT", 0, "talker2 first")
+    addSegment(1, "BAK_0_TEXT", 4096, "talker1 first")
+    addSegment(1, "BAK_1_TEXT", 0, "talker1 second")
+    addSegment(3, "BAK_10_TEXT", 0, "talker3 first")
+    addSegment(3, "BAK_2_TEXT", 0, "talker3 second")
+    addSegment(2, "BAK_1_TEXT", 0, "talker2 second")
+
+    resultList = []
+    for name, streamJson, parseWorkers in (("non-stream", False, 1), ("stream", True, 1), ("stream pool", True, 2)):
+        outputDir = rootDir / name
+        outputDir.mkdir()
+        for fileName, content in contentDict.items():
+            (outputDir / f"decrypt_{fileName}").write_bytes(content)
+
+        serializer = WechatSerializer(None)
+        serializer.callback = lambda isFinished, msg: None
+        serializer.outputDir = outputDir
+        serializer.streamJson = streamJson
+        serializer.parseWorkers = parseWorkers
+        serializer.sessionDict = {talkerId: WeChatSession(talkerId, f"talker{talkerId}", "", 0, 0)
+                                  for talkerId in (1, 2, 3)}
+        serializer.msgSegmentList = list(segmentList)
+        serializer.outputJson()
+        resultList.append((name, {path.name: path.read_bytes() for path in outputDir.glob("*.json")}))
+
+    for name, result in resultList[1:]:
+        print(f"{name}: same as non-stream: {result == resultList[0][1]}")
+    print(resultList[0][1]["talker1.json"].decode())
+    shutil.rmtree(rootDir)
+
+
 if __name__ == '__main__':
     setFileAttr()
@@ -5,28 +5,44 @@
 import os.path
 import pathlib
 import shutil
-from typing import List, Callable, Dict
+import time
+from typing import List, Callable, Dict, Union
 
 from PyQt5.QtCore import QObject, QThread
 
 from bean.beans import Account, SocialConfig
 from db.db_util import DBUtil
 from util import log
-from util.cpp_lib import CppLibrary
+from util.decrypt_channel import DecryptedFileChannel
+from util.decryptor import Decryptor, CppDecryptor, runDecryptTasks, stripHeader
+from util.file_sync import linkTree
+from util.output_generation import OutputGeneration
 
 
 class AppDecrypter(QObject):
     @staticmethod
     def decrypt(account: Account, outputDir: str,
                 callback: Callable[[List], None], parent: QObject,
-                showMsgCallback):
-        decryptThread = DecryptThread(account, outputDir, parent=parent, showMsgCallback=showMsgCallback)
+                showMsgCallback, incremental=False, channel: DecryptedFileChannel = None, workers=1,
+                generation: OutputGeneration = None):
+        decryptThread = DecryptThread(account, outputDir, parent=parent, showMsgCallback=showMsgCallback,
+                                      incremental=incremental, channel=channel, workers=workers,
+                                      generation=generation)
         decryptThread.start()
         decryptThread.finished.connect(lambda: callback(decryptThread.decryptResult))
 
 
 class DecryptThread(QThread):
-    def __init__(self, account: Account, outputDir: str, parent=None, showMsgCallback=None):
+    def __init__(self, account: Account, outputDir: str, parent=None, showMsgCallback=None, incremental=False,
+                 channel: DecryptedFileChannel = None, workers=1, decryptor: Decryptor = None,
+                 generation: OutputGeneration = None):
+        """
+        :param incremental: 增量导出时新的代目录沿用上次导出的用户文件，用户文件夹由序列化时增量同步
+        :param generation: 写入的代目录，为None时新建；由序列化全部成功后替换输出目录
+        :param channel: 流式导出时，每解密完一个文件就通过channel通知序列化线程
+        :param workers: 同时解密的文件数，1为依次解密
+        :param decryptor: 默认为调用dll的CppDecryptor
+        """
         super(DecryptThread, self).__init__(parent=parent)
         self.account = account
 
@@ -36,15 +52,16 @@ class DecryptThread(QThread):
         self.backupStatus = True
         self.dbMsg = "数据库解密成功"
         self.backupMsg = "备份数据解密成功"
-        self.cppLib = CppLibrary()
+        self.decryptor = decryptor if decryptor is not None else CppDecryptor()
+        self.workers = workers
 
         self.showMsgCallback = showMsgCallback
+        self.channel: Union[DecryptedFileChannel, None] = channel
 
-        self.outputDirPath = pathlib.Path(outputDir) / self.account.uid
-
-        # 确保输出目录是空的
-        shutil.rmtree(self.outputDirPath, ignore_errors=True)
-        self.outputDirPath.mkdir(parents=True, exist_ok=True)
+        # 写入新的代目录，不在界面线程中删除上一次的输出目录
+        self.generation = generation if generation is not None else OutputGeneration(outputDir, account.uid,
+                                                                                     incremental)
+        self.outputDirPath = self.generation.path
 
     def run(self):
         import pydevd
@@ -58,12 +75,44 @@ class DecryptThread(QThread):
             SocialConfig.QQ: self.decryptQQ,
             SocialConfig.WECOM: self.decryptWeCom
         }
-        runDict[self.appType]()
+        try:
+            self.generation.create()
+            runDict[self.appType]()
+        finally:
+            if self.channel is not None:
+                # 出现异常时decryptResult为空，同样通知序列化线程解密失败
+                self.channel.close(len(self.decryptResult) == 4 and self.dbStatus and self.backupStatus)
+
+    def linkDecryptTemp(self, dbDirPath: pathlib.Path):
+        """
+        把decrypt_temp中已解密的数据库放入输出目录。同一个卷上使用硬链接，不复制数据库；序列化只以只读方式打开这些数据库
+        """
+        start = time.perf_counter()
+        linkNum, copyNum = linkTree(dbDirPath, self.outputDirPath)
+        log.i(f"{dbDirPath}: 硬链接{linkNum}个文件，复制{copyNum}个文件，耗时{time.perf_counter() - start:.3f}s")
+
+    def publish(self, filePath: pathlib.Path):
+        """
+        通知序列化线程filePath已经解密完成
+        """
+        if self.channel is not None:
+            self.channel.publish(filePath.relative_to(self.outputDirPath))
+
+    def publishTree(self, srcDirPath: pathlib.Path):
+        """
+        通知序列化线程从srcDirPath复制到输出目录的文件已经可用，输出目录中原有的文件不算在内
+        """
+        if self.channel is None:
+            return
+        for filePath in sorted(srcDirPath.rglob("*")):
+            if filePath.is_file():
+                self.publish(self.outputDirPath / filePath.relative_to(srcDirPath))
 
     def decryptWechat(self):
         dbDirPath = pathlib.Path(f"{self.account.path}") / "decrypt_temp" / self.account.uid
         if dbDirPath.exists():
-            shutil.copytree(dbDirPath, self.outputDirPath, dirs_exist_ok=True)
+            self.linkDecryptTemp(dbDirPath)
+            self.publishTree(dbDirPath)
             self.dbMsg = "数据库解密成功"
         else:  # 没有数据库文件, 引导重新登录。
             log.i(f"解密数据库文件失败, {dbDirPath}")
@@ -77,30 +126,39 @@ class DecryptThread(QThread):
                 self.backupStatus = False
             else:
                 backupPath = backupRootPath / os.listdir(backupRootPath)[0]
-                for filePath in backupPath.glob("*"):
-                    self.showMsgCallback(2, f"正在解密{filePath.name}...")
+                taskList = []
+                # 先解密Backup.db，流式导出时序列化线程可以尽早开始读取数据库
+                for filePath in sorted(backupPath.glob("*"), key=lambda path: (path.name != "Backup.db", path.name)):
                     if filePath.name == "Backup.db":
-                        result = self.cppLib.decryptWeChatBackupDb(str(backupPath),
-                                                                   filePath.name,
-                                                                   str(self.outputDirPath),
-                                                                   self.account.keyBak)
-                        if result != 0:
-                            self.backupStatus = False
-                            self.backupMsg = f"解密{filePath.name}错误, {result} [1: 打开的文件不存在 2:key错误 3: 写入文件出错]"
-                            break
-
+                        decryptFunc = self.decryptor.decryptWeChatBackupDb
                     elif "MEDIA" in filePath.name or "TEXT" in filePath.name:
-                        result = self.cppLib.decryptWeChatBackupFile(str(backupPath),
-                                                                     filePath.name,
-                                                                     str(self.outputDirPath),
-                                                                     self.account.keyBak)
-                        if result != 0:
-                            self.backupStatus = False
-                            self.backupMsg = f"解密{filePath.name}错误：{result}"
-                            break
+                        decryptFunc = self.decryptor.decryptWeChatBackupFile
+                    else:
+                        continue
+                    taskList.append((filePath.name, self.__getWeChatTask(decryptFunc, backupPath, filePath.name)))
+
+                def onDone(fileName: str, result: int):
+                    if result == 0:
+                        self.publish(self.outputDirPath / f"decrypt_{fileName}")
+
+                fileName, result = runDecryptTasks(taskList, self.workers, onDone)
+                if result != 0:
+                    self.backupStatus = False
+                    if fileName == "Backup.db":
+                        self.backupMsg = f"解密{fileName}错误, {result} [1: 打开的文件不存在 2:key错误 3: 写入文件出错]"
+                    else:
+                        self.backupMsg = f"解密{fileName}错误：{result}"
 
         self.generateResult()
 
+    def __getWeChatTask(self, decryptFunc: Callable[[str, str, str, str], int], backupPath: pathlib.Path,
+                        fileName: str) -> Callable[[], int]:
+        def task():
+            self.showMsgCallback(2, f"正在解密{fileName}...")
+            return decryptFunc(str(backupPath), fileName, str(self.outputDirPath), self.account.keyBak)
+
+        return task
+
     def decryptQQ(self):
         dbUtil = DBUtil()
         appInstallRes = dbUtil.exec(DBUtil.SQL_GET_APP_INSTALL_PATH, self.appType, needResult=False, dictResult=True)
@@ -115,52 +173,59 @@ class DecryptThread(QThread):
             dbKeyPair = dbKeyPairStr.split("&")
             dbKeyDict[dbKeyPair[0]] = dbKeyPair[1]
 
+        kernelDllPath = str(pathlib.Path(appPath) / "KernelUtil.dll")
+        taskList = []
         for dbPathStr, dbKey in dbKeyDict.items():
             dbPath = pathlib.Path(dbPathStr)
             dbName = dbPath.name
-            self.showMsgCallback(2, f"正在解密{dbName}")
             if dbPath.parent.parent.name == "MsgBackup":
                 backupDstPath = self.outputDirPath / "MsgBackup"
                 backupDstPath.mkdir(parents=True, exist_ok=True)
                 dstPath = backupDstPath / dbName
             else:
                 dstPath = self.outputDirPath / dbName
-            # 先复制到输出文件夹
-            shutil.copyfile(dbPathStr, dstPath)
 
             keyStr = dbKey.replace("0x", "").replace(",", "")
-            keyArr = bytearray.fromhex(keyStr)
-
-            # 调用C++， 使用sqlite3_rekey解密源文件
-            decRes = self.cppLib.decryptQQDb(str(pathlib.Path(appPath) / "KernelUtil.dll"), str(dstPath), keyArr)
-
-            if decRes == 0:
-                # 从第1024字节读取文件
-                with open(dstPath, mode="rb") as dbWithEmptyHeader:
-                    dbWithEmptyHeader.seek(1024)
-                    fileBin = dbWithEmptyHeader.read()
+            taskList.append((str(dstPath), self.__getQQTask(kernelDllPath, dbPathStr, dstPath, bytearray.fromhex(keyStr))))
 
-                # 写入新文件
-                with open(dstPath.parent / ("decrypt_" + dbName + ".db"), mode="wb+") as dbDecrypted:
-                    dbDecrypted.write(fileBin)
+        def onDone(dstPathStr: str, result: int):
+            if result == 0:
+                dstPath = pathlib.Path(dstPathStr)
+                self.publish(dstPath.parent / ("decrypt_" + dstPath.name + ".db"))
 
-                # 删除原来带空头的文件
-                pathlib.Path(dstPath).unlink(missing_ok=True)
-
-            else:
-                self.dbStatus = False
-                self.dbMsg = f"数据库{dbName}解密失败，错误码{decRes}。[21: 程序错误。26: Key错误。]"
-                break
+        dstPathStr, decRes = runDecryptTasks(taskList, self.workers, onDone)
+        if decRes != 0:
+            self.dbStatus = False
+            self.dbMsg = f"数据库{pathlib.Path(dstPathStr).name}解密失败，错误码{decRes}。[21: 程序错误。26: Key错误。]"
 
         self.backupStatus = True
         self.backupMsg = "备份数据库解密成功"
 
         self.generateResult()
 
+    def __getQQTask(self, kernelDllPath: str, srcPath: str, dstPath: pathlib.Path, keyArr: bytearray) \
+            -> Callable[[], int]:
+        def task():
+            self.showMsgCallback(2, f"正在解密{dstPath.name}")
+            # 先复制到输出文件夹
+            shutil.copyfile(srcPath, dstPath)
+
+            # 调用C++， 使用sqlite3_rekey解密源文件
+            decRes = self.decryptor.decryptQQDb(kernelDllPath, str(dstPath), keyArr)
+            if decRes != 0:
+                return decRes
+
+            # 去掉前1024字节的空头，得到新文件
+            stripHeader(str(dstPath), str(dstPath.parent / ("decrypt_" + dstPath.name + ".db")))
+            return 0
+
+        return task
+
     def decryptWeCom(self):
         dbDirPath = pathlib.Path(f"{self.account.path}") / "decrypt_temp" / self.account.uid
         if dbDirPath.exists() and len(os.listdir(dbDirPath)) > 5:
-            shutil.copytree(dbDirPath, self.outputDirPath, dirs_exist_ok=True)
+            self.linkDecryptTemp(dbDirPath)
+            self.publishTree(dbDirPath)
             self.dbMsg = "数据库解密成功"
         else:
             log.i(f"解密数据库文件失败, {dbDirPath}")
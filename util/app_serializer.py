@@ -2,20 +2,86 @@
 针对已经解密的文件，进行序列化；复制用户目录下的非加密资源或解密加密资源
 """
 
+import itertools
 import os.path
 import pathlib
+import re
 import shutil
+import sqlite3
+import threading
+import time
 from abc import abstractmethod
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from dataclasses import dataclass
-from typing import List, Callable, Union, Dict
+from typing import List, Callable, Union, Dict, Tuple, Iterator, BinaryIO, Iterable, Any
 
 import unicodedata
 from PyQt5.QtCore import QObject, QThread
 
 from bean.beans import Account, SocialConfig
-from db.db_util import DBUtil
+from db.db_util import DBUtil, SqliteReader
 from util import log
-from util.tools import Utility
+from util.blob_decoder import TagBlobDecoder, WIRE_LENGTH, WIRE_VARINT, WIRE_64BIT, WIRE_32BIT, MAX_DEPTH
+from util.dat_decoder import DatDecoder
+from util.decrypt_channel import DecryptedFileChannel
+from util.file_sync import SyncManifest
+from util.output_generation import OutputGeneration
+from util.shard_runner import ShardRunner
+from util.spill_store import SpillGroupStore
+from util.tools import Utility, JsonListWriter, MappedFileReader, SNIFF_HEADER_SIZE
+
+
+_controlCharPattern: Union[re.Pattern, None] = None
+astralCharPattern = re.compile("[\U00010000-\U0010ffff]")
+
+
+def _getControlCharPattern() -> re.Pattern:
+    """
+    匹配BMP中所有unicodedata.category以C开头的字符（Cc Cf Cs Co Cn），第一次使用时生成。
+    只包含BMP中的字符时，re可以用位图匹配，比逐个字符调用unicodedata.category快得多。
+    """
+    global _controlCharPattern
+    if _controlCharPattern is None:
+        rangeList = []
+        for code in range(0x10000):
+            if unicodedata.category(chr(code))[0] == "C":
+                if len(rangeList) != 0 and rangeList[-1][1] == code - 1:
+                    rangeList[-1][1] = code
+                else:
+                    rangeList.append([code, code])
+        charClass = "".join(f"\\u{start:04x}-\\u{end:04x}" for start, end in rangeList)
+        _controlCharPattern = re.compile(f"[{charClass}]+")
+    return _controlCharPattern
+
+
+def _filterAstralChar(match: re.Match) -> str:
+    ch = match.group()
+    return "" if unicodedata.category(ch)[0] == "C" else ch
+
+
+def decodeUtf8(line: Union[bytes, memoryview]) -> str:
+    """
+    去掉所有非UTF-8字符和unicodedata.category以C开头的字符，转换成str
+    """
+    result = str(line, "utf-8", 'ignore')
+    # 可打印的字符串一定不含C类字符
+    if result.isprintable():
+        return result
+    # BMP以外的字符（如emoji）很少，逐个判断；不可打印的字符都在BMP以外时，去掉后不必再匹配BMP的C类字符
+    if astralCharPattern.search(result) is not None:
+        result = astralCharPattern.sub(_filterAstralChar, result)
+        if result.isprintable():
+            return result
+    return _getControlCharPattern().sub("", result)
+
+
+@dataclass
+class SerializeStage:
+    name: str
+    execute: Callable[[], bool]
+    prompt: Union[str, None]
+    dependList: List[str]  # 必须先完成的阶段
 
 
 # noinspection SqlDialectInspection
@@ -30,6 +96,12 @@ class AppSerializer(QObject):
 
         self.callback: Callable[[bool, str], None] = Callable[[bool, str], None]  # bool 是否结束 str msg
         self.outputDir: pathlib.Path = pathlib.Path()  # 解密路径 + 用户ID
+        self.incrementalSync = False  # 根据输出目录中的清单，只复制或解密新增及变化的用户文件
+        self.shardWorkers = min(4, os.cpu_count() or 1)  # 按会话分片输出Json、提取文件的并行数，1为在当前线程依次处理
+        self.shardUseProcess = False  # 分片使用进程池而不是线程池
+        self.parallelStages = True  # 没有依赖关系的阶段同时执行，False为按_getStageList的顺序依次执行
+        self.decryptChannel: Union[DecryptedFileChannel, None] = None  # 流式导出时，由DecryptThread逐个通知已解密的文件
+        self.outputGeneration: Union[OutputGeneration, None] = None  # 与DecryptThread写入同一个代目录，全部成功后替换输出目录
 
     @staticmethod
     def getInstance(account: Account):
@@ -59,29 +131,111 @@ class AppSerializer(QObject):
         except ConnectionRefusedError as e:
             print(e)
 
-        self.callback = callback
+        failEvent = threading.Event()
 
-        executeList = [self._getOutputPath,
-                       self.readDatabase,
-                       self.outputJson,
-                       self.extractMedia,
-                       self.copyUserDir]
+        def stageCallback(isFinished: bool, msg: str):
+            # 某个阶段失败后，不再显示其它正在执行的阶段的进度
+            if failEvent.is_set() and not isFinished:
+                return
+            callback(isFinished, msg)
+
+        self.callback = stageCallback
+
+        stageList = self._getStageList()
+        pendingList = list(stageList)
+        doneSet = set()
+        maxRunning = len(stageList) if self.parallelStages else 1
+
+        with ThreadPoolExecutor(maxRunning) as executor:
+            futureDict: Dict[Future, SerializeStage] = {}
+            while True:
+                # 依赖的阶段都已完成的阶段按顺序开始执行；有阶段失败后不再开始新的阶段
+                for stage in list(pendingList):
+                    if failEvent.is_set() or len(futureDict) >= maxRunning:
+                        break
+                    if all(depend in doneSet for depend in stage.dependList):
+                        pendingList.remove(stage)
+                        futureDict[executor.submit(self.__runStage, stage)] = stage
+
+                if len(futureDict) == 0:
+                    break
 
-        promptList = [None, "正在读取数据库...", "正在将聊天记录转换成Json...", "正在提取媒体文件...", "正在复制用户文件夹..."]
+                doneFutureSet, _ = wait(futureDict, return_when=FIRST_COMPLETED)
+                for future in doneFutureSet:
+                    stage = futureDict.pop(future)
+                    success, errorMsg = future.result()
+                    if success:
+                        doneSet.add(stage.name)
+                        continue
+                    if not failEvent.is_set() and errorMsg is not None:
+                        callback(True, errorMsg)
+                    failEvent.set()
+
+        # 流式导出时序列化可能先于解密结束，等待解密全部完成；解密失败时不替换上一次的导出
+        if not failEvent.is_set() and self.decryptChannel is not None and not self.decryptChannel.waitClosed():
+            callback(True, "备份数据没有全部解密成功，已取消本次导出。")
+            failEvent.set()
+
+        if failEvent.is_set():
+            if self.outputGeneration is not None:
+                self.outputGeneration.discard()
+            return
+
+        if self.outputGeneration is not None and not self.outputGeneration.commit():
+            callback(True, f"全部数据已经解密及序列化成功，但{self.outputGeneration.finalPath}正在被使用，无法替换，"
+                           f"本次导出保存在{self.outputGeneration.path}。")
+            return
+        callback(True, "全部数据已经解密及序列化成功。")
+
+    def _getStageList(self) -> List[SerializeStage]:
+        """
+        各阶段及其依赖。copyUserDir只需要输出路径，与读取数据库、输出Json同时执行；extractMedia只依赖readDatabase。
+        """
+        return [SerializeStage("outputPath", self._getOutputPath, None, []),
+                SerializeStage("readDatabase", self.readDatabase, "正在读取数据库...", ["outputPath"]),
+                SerializeStage("outputJson", self.outputJson, "正在将聊天记录转换成Json...", ["readDatabase"]),
+                SerializeStage("extractMedia", self.extractMedia, "正在提取媒体文件...", ["readDatabase"]),
+                SerializeStage("copyUserDir", self.copyUserDir, "正在复制用户文件夹...", ["outputPath"])]
 
-        for i, execute in enumerate(executeList):
-            if promptList[i] is not None:
-                self.callback(False, promptList[i])
-            try:
-                if not execute():
-                    return
-            except FileNotFoundError as e:
-                self.callback(True, f"{promptList[i]}发生错误: \n{e}")
-                return
+    def __runStage(self, stage: SerializeStage) -> Tuple[bool, Union[str, None]]:
+        """
+        :return: (是否成功, 错误信息)；阶段返回False时已经自己报告了错误，错误信息为None
+        """
+        if stage.prompt is not None:
+            self.callback(False, stage.prompt)
+        try:
+            return stage.execute(), None
+        except (FileNotFoundError, sqlite3.Error) as e:
+            return False, f"{stage.prompt}发生错误: \n{e}"
 
-        self.callback(True, "全部数据已经解密及序列化成功。")
+    def _runShards(self, shardIter: Iterable[Tuple[Any, tuple]], func: Callable, prompt: str, total=0) -> int:
+        """
+        按会话分片并行执行func，出错的会话不影响其它会话，全部完成后报告出错的会话。
+        有会话出错时调用的阶段应返回False，不替换上一次的导出。
+        :return: 出错的会话数
+        """
+        runner = ShardRunner(self.shardWorkers, self.shardUseProcess, self.callback)
+        runner.run(shardIter, func, prompt, total)
+        if len(runner.errorList) != 0:
+            self.callback(True, f"{prompt}{len(runner.errorList)}个会话处理失败: " +
+                          ", ".join(str(key) for key, _ in runner.errorList))
+        return len(runner.errorList)
+
+    def _waitDecrypted(self, relativePath: str) -> bool:
+        """
+        流式导出时等待输出目录下的relativePath解密完成，非流式导出时直接返回True
+        :return: 文件是否已解密；解密失败或没有该文件时返回False
+        """
+        if self.decryptChannel is None:
+            return True
+        return self.decryptChannel.waitFile(relativePath)
 
     def _getOutputPath(self) -> bool:
+        if self.outputGeneration is not None:
+            self.outputGeneration.create()
+            self.outputDir = self.outputGeneration.path
+            return True
+
         du = DBUtil()
         res, settings = du.exec(DBUtil.SQL_QUERY_SETTINGS, needResult=True, dictResult=True)
         if not res:
@@ -124,6 +278,17 @@ class AppSerializer(QObject):
         """
         pass
 
+    def _copyDir(self, srcPath: pathlib.Path, dstPath: pathlib.Path, manifest: Union[SyncManifest, None],
+                 ignorePattern: Union[str, None] = None):
+        """
+        复制文件夹，manifest不为None时只复制新增及变化的文件
+        """
+        if manifest is not None:
+            manifest.syncTree(srcPath, dstPath, ignorePattern)
+        else:
+            ignore = shutil.ignore_patterns(ignorePattern) if ignorePattern is not None else None
+            shutil.copytree(srcPath, dstPath, dirs_exist_ok=True, ignore=ignore)
+
     @staticmethod
     def __getFormat(code: int) -> int:
         """
@@ -141,13 +306,11 @@ class AppSerializer(QObject):
             return 4
         return -1
 
-    def _decodeUtf8(self, line: bytes) -> str:
+    def _decodeUtf8(self, line: Union[bytes, memoryview]) -> str:
         """
         将bytes出去所有非UTF-8字符，转换成str
         """
-        result = line.decode("utf-8", 'ignore')
-        result = "".join(ch for ch in result if unicodedata.category(ch)[0] != "C")
-        return result
+        return decodeUtf8(line)
 
         # result = bytearray()
         # index = -1
@@ -220,29 +383,44 @@ class WeChatMsgSegment:
     fileName: str
 
 
-weChatIdRangeList = list(range(97, 123))
-weChatIdRangeList.extend(list(range(65, 91)))
-weChatIdRangeList.extend(list(range(48, 58)))
-weChatIdRangeList.extend([64, 95])
+@dataclass
+class WeChatRecord:
+    sender: str
+    message: str
+    mediaId: str
+
+
+# id范围 0-9 a-z A-Z _ @
+weChatIdPattern = re.compile(r"[A-Za-z0-9_@]*")
+weChatIdFullPattern = re.compile(r"[A-Za-z0-9_@]{6,24}")  # 一个完整的文本字段是否为微信ID
+controlBytesPattern = re.compile(rb"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")  # 文本字段中不会出现的控制字符
 
 
 # noinspection SqlDialectInspection
 class WechatSerializer(AppSerializer):
+    PARSE_BATCH_SIZE = 64  # 每次交给解析进程的Segment数量
+    MEDIA_COPY_BUFFER_SIZE = 1024 * 1024
+
     def __init__(self, account):
         super(WechatSerializer, self).__init__(account)
         self.sessionDict: Dict[int, WeChatSession] = {}  # {key: talkerId value:Session}
         self.mediaDict: Dict[int, WeChatMedia] = {}  # {key: talkerId, value: Media}
         self.msgSegmentList: List[WeChatMsgSegment] = []
+        self.streamJson = True  # 按talker流式写入Json，内存只保留一个Segment
+        self.parseWorkers = os.cpu_count() or 1  # 解析聊天记录的进程数，1为在当前线程解析
+        self.imageDecodeWorkers = 4  # 解密dat图片的线程数
+        self.decodeImageFromSource = True  # dat图片直接从源目录解密到输出目录，不先复制dat文件
+        self.structuredText = False  # 按tag结构解析BAK_*_TEXT；用真实的BAK_*_TEXT验证之前默认使用按行猜测的旧方式
         # self.typeListFiltered = []  # 0 ID 1 普通消息 2 数据库字段
         # self.textListFiltered = []
 
         self.chatMsgList = ()  # placeholder
 
-    def _parseChatText(self, textSegment: bytes) -> List:
+    def _parseChatText(self, textSegment: Union[bytes, memoryview]) -> List:
         idNum = 0
         textList: List[List[int, str]] = []  # -1 被过滤了 0 ID 1 普通消息 2 数据库
 
-        for i, line in enumerate(textSegment.splitlines()):
+        for i, line in enumerate(bytes(textSegment).splitlines()):
             if i == 0:
                 continue
             text = self._decodeUtf8(line)
@@ -283,44 +461,149 @@ class WechatSerializer(AppSerializer):
             textList.append(textTuple)
         return textList
 
+    def _decodeChatRecords(self, textSegment: Union[bytes, memoryview]) -> List[WeChatRecord]:
+        """
+        按tag + varint长度的结构单次遍历Segment，取出所有文本字段，再按顺序组合为记录：
+        1. 长度6~24且全部是ID字符的字段是微信ID，记录的第一个ID是发送者；连续两个ID之后的字段一定不是ID
+        2. 包含_backup且在mediaDict中的字段是mediaId
+        3. 其余文本字段是消息，同一条记录的多段消息以换行连接；消息之后再出现ID时开始下一条记录
+        """
+        textList: List[str] = []
+        self.__collectTextFields(memoryview(textSegment), 0, len(textSegment), 0, textList)
+
+        recordList: List[WeChatRecord] = []
+        sender = ""
+        messageList: List[str] = []
+        mediaId = ""
+        idNum = 0
+
+        for text in textList:
+            if idNum < 2 and weChatIdFullPattern.fullmatch(text) is not None:
+                if len(messageList) != 0 or len(mediaId) != 0:
+                    recordList.append(WeChatRecord(sender or "unknown_wechat_id", "\n".join(messageList), mediaId))
+                    sender = ""
+                    messageList = []
+                    mediaId = ""
+                if idNum == 0:
+                    sender = text
+                idNum += 1
+                continue
+
+            idNum = 0
+            index = text.rfind("_backup")
+            if index != -1 and text[0:index + 7] in self.mediaDict:
+                mediaId = text[0:index + 7] + ("__thumb" if "__thumb" in text else "")
+            else:
+                messageList.append(text)
+
+        if len(sender) != 0 or len(messageList) != 0 or len(mediaId) != 0:
+            recordList.append(WeChatRecord(sender or "unknown_wechat_id", "\n".join(messageList), mediaId))
+        return recordList
+
+    def __collectTextFields(self, mv: memoryview, start: int, end: int, depth: int, textList: List[str]):
+        """
+        按顺序把mv[start:end]中的文本字段加入textList，嵌套的字段递归展开。
+        遇到无法解析的位置时跳到下一个0x0a继续，与按行解析一样不会丢弃后面的内容。
+        """
+        pos = start
+        while pos < end:
+            tag, valueStart = TagBlobDecoder.readVarint(mv, pos, end)
+            fieldNo, wireType = tag >> 3, tag & 0x07
+            valueEnd = -1
+
+            if tag > 0 and fieldNo != 0:
+                if wireType == WIRE_LENGTH:
+                    length, valueStart = TagBlobDecoder.readVarint(mv, valueStart, end)
+                    if 0 <= length <= end - valueStart and \
+                            self.__acceptLengthField(mv, valueStart, valueStart + length, depth, textList):
+                        valueEnd = valueStart + length
+                elif wireType == WIRE_VARINT:
+                    _, valueEnd = TagBlobDecoder.readVarint(mv, valueStart, end)
+                elif wireType == WIRE_64BIT:
+                    valueEnd = valueStart + 8
+                elif wireType == WIRE_32BIT:
+                    valueEnd = valueStart + 4
+
+            if 0 <= valueEnd <= end:
+                pos = valueEnd
+                continue
+
+            pos += 1
+            while pos < end and mv[pos] != 0x0a:
+                pos += 1
+
+    def __acceptLengthField(self, mv: memoryview, start: int, end: int, depth: int, textList: List[str]) -> bool:
+        """
+        长度前缀字段的内容是嵌套结构时展开，是文本时加入textList，都不是时返回False。
+        先尝试嵌套结构：32~127字节的嵌套字段，其tag和长度都是可打印字符，按文本判断会把tag和长度当成文本输出
+        """
+        if depth < MAX_DEPTH:
+            fields = TagBlobDecoder.parseFields(mv, start, end)
+            # 只有varint等定长字段的短文本（如"hi"）也能恰好解析，要求至少有一个长度前缀字段
+            if fields is not None and any(field[1] == WIRE_LENGTH for field in fields):
+                self.__collectTextFields(mv, start, end, depth + 1, textList)
+                return True
+
+        value = mv[start:end]
+        if controlBytesPattern.search(value) is None:
+            try:
+                text = str(value, "utf-8")
+            except UnicodeDecodeError:
+                return False
+            if len(text) > 1:
+                textList.append(text)
+            return True
+        return False
+
+    def _parseSegment(self, index, msgSegment: WeChatMsgSegment, textSegment: Union[bytes, memoryview]) -> Dict:
+        if self.structuredText:
+            return self._generateRecordJsonDict(index, msgSegment, self._decodeChatRecords(textSegment))
+        return self._generateMsgSegmentJsonDict(index, msgSegment, self._parseChatText(textSegment))
+
     # noinspection SqlResolve
     def readDatabase(self) -> bool:
         backupDbPath = self.outputDir / "decrypt_Backup.db"
         log.d(self.outputDir, backupDbPath)
-        if not backupDbPath.exists():
+        if not self._waitDecrypted(backupDbPath.name) or not backupDbPath.exists():
             self.callback(True, f"在{str(backupDbPath)}中没有找到解密后的Backup.db。")
             return False
 
-        backupDbUtil = DBUtil(str(backupDbPath), False)
-        res, sessions = backupDbUtil.exec("select talker, NickName, StartTime, EndTime from Session")
-        if not res:
+        backupDb = SqliteReader(str(backupDbPath))
+        sessions = backupDb.exec("select talker, NickName, StartTime, EndTime from Session")
+        if len(sessions) == 0:
             self.callback(True, "查询Backup.db中的Session失败。")
 
         for i, session in enumerate(sessions):
             self.sessionDict[i + 1] = WeChatSession(i + 1, session[0], session[1], session[2], session[3])
 
-        res, medias = backupDbUtil.exec("select MsgMedia.MediaId, MsgMedia.MediaIdStr, "
-                                        "MsgFileSegment.Offset, MsgFileSegment.TotalLen, MsgFileSegment.FileName, "
-                                        "MsgMedia.talker "
-                                        "from MsgMedia join MsgFileSegment "
-                                        "on MsgMedia.MediaId = MsgFileSegment.MapKey "
-                                        "where MsgFileSegment.InnerOffSet = 0")
-
-        if not res:
+        # MsgFileSegment.MapKey没有索引，先把需要的行放入带索引的临时表再join
+        self.callback(False, "正在建立临时索引...")
+        backupDb.createTempIndex("MediaSegment",
+                                 "select MapKey, Offset, TotalLen, FileName from MsgFileSegment where InnerOffSet = 0",
+                                 ["MapKey"])
+        start = time.perf_counter()
+        medias = backupDb.exec("select MsgMedia.MediaId, MsgMedia.MediaIdStr, "
+                               "MediaSegment.Offset, MediaSegment.TotalLen, MediaSegment.FileName, "
+                               "MsgMedia.talker "
+                               "from MsgMedia join temp.MediaSegment "
+                               "on MsgMedia.MediaId = MediaSegment.MapKey")
+        log.i(f"MsgMedia join MediaSegment 耗时{time.perf_counter() - start:.3f}s")
+
+        if len(medias) == 0:
             self.callback(True, "查询Backup.db中的MsgMedia join MsgFileSegment失败。")
         for media in medias:
             self.mediaDict[media[1]] = WeChatMedia(media[0], media[2], media[3], media[1], media[4], media[5])
 
-        res, msgSegments = backupDbUtil.exec("select talkerId, StartTime, EndTime, OffSet, Length, UsrName, FilePath "
-                                             "from MsgSegments")
-        if not res:
+        msgSegments = backupDb.exec("select talkerId, StartTime, EndTime, OffSet, Length, UsrName, FilePath "
+                                    "from MsgSegments")
+        if len(msgSegments) == 0:
             self.callback(True, "查询Backup.db中的MsgSegments失败。")
 
         for msgSegment in msgSegments:
             self.msgSegmentList.append(WeChatMsgSegment(msgSegment[0], msgSegment[1], msgSegment[2], msgSegment[3],
                                                         msgSegment[4], msgSegment[5], msgSegment[6]))
 
-        backupDbUtil.close()
+        backupDb.close()
         return True
 
     # def outputJsonDeprecated(self) -> bool:
@@ -338,6 +621,9 @@ class WechatSerializer(AppSerializer):
     #     return True
 
     def outputJson(self) -> bool:
+        if self.streamJson:
+            return self._outputJsonStreaming()
+
         msgSegmentLen = len(self.msgSegmentList)
 
         # 总Dict
@@ -351,23 +637,17 @@ class WechatSerializer(AppSerializer):
             if msgSegment.takerId not in msgTextJsonObjListDict:
                 segmentNum = 0
                 sessionInfo = self.sessionDict[msgSegment.takerId]
-                msgTextJsonObjListDict[msgSegment.takerId] = [{
-                    "WeChatId": sessionInfo.talker,
-                    "NickName": sessionInfo.nickName,
-                    "StartTime": Utility.getFormatTime(sessionInfo.startTime / 1000),
-                    "EndTime": Utility.getFormatTime(sessionInfo.endTime / 1000)
-                }]
+                msgTextJsonObjListDict[msgSegment.takerId] = [self._generateSessionJsonDict(sessionInfo)]
 
             segmentNum += 1
 
             bakTextPath = self.outputDir / f"decrypt_{msgSegment.fileName}"
-            if not bakTextPath.exists():
+            if not self._waitDecrypted(bakTextPath.name) or not bakTextPath.exists():
                 self.callback(True, f"没有在{str(self.outputDir)}下找到decrypt_{msgSegment.fileName}")
                 return False
 
             msgSegBytes = Utility.readFile(bakTextPath, msgSegment.offset, msgSegment.length)
-            msgList = self._parseChatText(msgSegBytes)
-            jsonObj = self._generateMsgSegmentJsonDict(segmentNum, msgSegment, msgList)
+            jsonObj = self._parseSegment(segmentNum, msgSegment, msgSegBytes)
             msgTextJsonObjListDict[msgSegment.takerId].append(jsonObj)
 
         for index, talkerId in enumerate(msgTextJsonObjListDict):
@@ -382,6 +662,130 @@ class WechatSerializer(AppSerializer):
 
         return True
 
+    def _outputJsonStreaming(self) -> bool:
+        """
+        按talker分组后逐个解析Segment，每个talker的Json边解析边写入文件，talker变化时关闭文件。
+        组内保持msgSegmentList中的顺序（与非流式输出相同），一个talker可能跨越多个BAK_*_TEXT，不能只按offset排序；
+        talker之间按其第一个Segment在文件中的位置排序，使BAK_*_TEXT基本按顺序读取。
+        输出与outputJson的非流式结果一致。
+        """
+        msgSegmentLen = len(self.msgSegmentList)
+
+        # 流式导出时BAK_*_TEXT可能还在解密，在_iterSegmentJsonDict中用到时再等待
+        for fileName in {msgSegment.fileName for msgSegment in self.msgSegmentList}:
+            if self.decryptChannel is None and not (self.outputDir / f"decrypt_{fileName}").exists():
+                self.callback(True, f"没有在{str(self.outputDir)}下找到decrypt_{fileName}")
+                return False
+
+        talkerFirstPosDict: Dict[int, tuple] = {}  # {talkerId: (BAK文件序号, offset)}
+        for msgSegment in self.msgSegmentList:
+            pos = (self._getBakFileIndex(msgSegment.fileName), msgSegment.offset)
+            if msgSegment.takerId not in talkerFirstPosDict or pos < talkerFirstPosDict[msgSegment.takerId]:
+                talkerFirstPosDict[msgSegment.takerId] = pos
+
+        # sorted是稳定排序，同一talker的Segment保持原来的顺序
+        sortedIndexList = sorted(range(len(self.msgSegmentList)),
+                                 key=lambda i: (talkerFirstPosDict[self.msgSegmentList[i].takerId],
+                                                self.msgSegmentList[i].takerId))
+
+        # 按msgSegmentList的顺序预先计算Segment序号，规则与非流式输出相同：计数只在第一次遇到某个talker时清零，
+        # talker交错出现时序号会接着其它talker的计数
+        segmentNumList: List[int] = []
+        talkerIdSet = set()
+        segmentNum = 0
+        for msgSegment in self.msgSegmentList:
+            if msgSegment.takerId not in talkerIdSet:
+                talkerIdSet.add(msgSegment.takerId)
+                segmentNum = 0
+            segmentNum += 1
+            segmentNumList.append(segmentNum)
+
+        # 解析可以乱序进行，结果按taskList的顺序取回
+        taskList: List[Tuple[str, int, WeChatMsgSegment]] = []  # (bakTextPath, segmentNum, msgSegment)
+        for index in sortedIndexList:
+            msgSegment = self.msgSegmentList[index]
+            taskList.append((str(self.outputDir / f"decrypt_{msgSegment.fileName}"), segmentNumList[index],
+                             msgSegment))
+
+        writer: Union[JsonListWriter, None] = None
+        lastTalkerId = None
+
+        try:
+            for i, jsonObj in enumerate(self._iterSegmentJsonDict(taskList)):
+                self.callback(False, f"正在解析聊天记录...{i / msgSegmentLen * 100:.2f}%")
+
+                msgSegment = taskList[i][2]
+                if msgSegment.takerId != lastTalkerId:
+                    if writer is not None:
+                        writer.close()
+                    lastTalkerId = msgSegment.takerId
+                    sessionInfo = self.sessionDict[msgSegment.takerId]
+                    writer = JsonListWriter(self.outputDir / f"{sessionInfo.talker}.json", errors="ignore")
+                    writer.append(self._generateSessionJsonDict(sessionInfo))
+
+                writer.append(jsonObj)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        return True
+
+    def _iterSegmentJsonDict(self, taskList: List[Tuple[str, int, WeChatMsgSegment]]) -> Iterator[Dict]:
+        """
+        按taskList的顺序返回每个Segment解析后的Json字典。
+        parseWorkers大于1时，按批次交给进程池解析，只传递文件路径、offset和length，不传递Segment内容。
+        """
+        if self.parseWorkers <= 1:
+            with MappedFileReader() as reader:
+                for bakTextPath, segmentNum, msgSegment in taskList:
+                    self.__waitBakText(bakTextPath)
+                    msgSegView = reader.read(bakTextPath, msgSegment.offset, msgSegment.length)
+                    jsonDict = self._parseSegment(segmentNum, msgSegment, msgSegView)
+                    msgSegView.release()
+                    yield jsonDict
+            return
+
+        def iterBatch():
+            for i in range(0, len(taskList), self.PARSE_BATCH_SIZE):
+                batch = taskList[i:i + self.PARSE_BATCH_SIZE]
+                for bakTextPath in {task[0] for task in batch}:
+                    self.__waitBakText(bakTextPath)
+                yield batch
+
+        batchIter = iterBatch()
+        with ProcessPoolExecutor(self.parseWorkers, initializer=_initParseWorker,
+                                 initargs=(list(self.mediaDict.keys()), self.structuredText)) as executor:
+            # 限制在途的批次数量，使内存占用有界
+            futureQueue = deque(executor.submit(_parseSegmentBatch, batch)
+                                for batch in itertools.islice(batchIter, self.parseWorkers * 2))
+            while len(futureQueue) != 0:
+                result = futureQueue.popleft().result()
+                nextBatch = next(batchIter, None)
+                if nextBatch is not None:
+                    futureQueue.append(executor.submit(_parseSegmentBatch, nextBatch))
+                yield from result
+
+    @staticmethod
+    def _getBakFileIndex(fileName: str) -> int:
+        """
+        BAK_10_TEXT返回10。直接比较文件名时BAK_10_TEXT会排在BAK_2_TEXT之前
+        """
+        match = re.search(r"\d+", fileName)
+        return int(match.group()) if match is not None else -1
+
+    def __waitBakText(self, bakTextPath: str):
+        if not self._waitDecrypted(os.path.basename(bakTextPath)):
+            raise FileNotFoundError(f"{bakTextPath}没有解密成功")
+
+    @staticmethod
+    def _generateSessionJsonDict(sessionInfo: WeChatSession) -> Dict:
+        return {
+            "WeChatId": sessionInfo.talker,
+            "NickName": sessionInfo.nickName,
+            "StartTime": Utility.getFormatTime(sessionInfo.startTime / 1000),
+            "EndTime": Utility.getFormatTime(sessionInfo.endTime / 1000)
+        }
+
     # noinspection SpellCheckingInspection
     def __getMsgType(self, msg: str) -> [int, str]:
         """
@@ -422,16 +826,36 @@ class WechatSerializer(AppSerializer):
     #     return True
 
     def extractMedia(self) -> bool:
-        index = 0
-        for mediaIdStr, media in self.mediaDict.items():
-            index += 1
-            if index % 12 == 0:
-                self.callback(False, f"正在提取文件...{index}/{len(self.mediaDict)}")
-            filePath = self.outputDir / f"decrypt_{media.fileName}"
-            fileBytes = Utility.readFile(filePath, media.offset, media.length)
-            outputFilePath = self.outputDir / media.talkerId
-            outputFilePath.mkdir(parents=True, exist_ok=True)
-            Utility.writeFile(outputFilePath / media.mediaIdStr, fileBytes, True)
+        """
+        按(文件, offset)顺序提取，每个BAK_*_MEDIA只打开一次；只读取文件头判断类型，内容直接在文件之间复制
+        """
+        mediaList = sorted(self.mediaDict.values(), key=lambda m: (m.fileName, m.offset))
+        srcFileDict: Dict[str, BinaryIO] = {}  # {fileName: 文件}
+        buffer = bytearray(self.MEDIA_COPY_BUFFER_SIZE)
+
+        try:
+            for index, media in enumerate(mediaList, 1):
+                if index % 12 == 0:
+                    self.callback(False, f"正在提取文件...{index}/{len(self.mediaDict)}")
+
+                if media.fileName not in srcFileDict:
+                    if not self._waitDecrypted(f"decrypt_{media.fileName}"):
+                        raise FileNotFoundError(f"decrypt_{media.fileName}没有解密成功")
+                    srcFileDict[media.fileName] = open(self.outputDir / f"decrypt_{media.fileName}", 'rb')
+                fr = srcFileDict[media.fileName]
+
+                fr.seek(media.offset, 0)
+                header = fr.read(min(media.length, SNIFF_HEADER_SIZE))
+                fileExt = Utility.getFileExtByBytes(header)
+
+                outputFilePath = self.outputDir / media.talkerId
+                outputFilePath.mkdir(parents=True, exist_ok=True)
+                with open(outputFilePath / (media.mediaIdStr + fileExt), 'wb') as fw:
+                    Utility.copyFileRange(fr, fw, media.offset, media.length, buffer)
+        finally:
+            for fr in srcFileDict.values():
+                fr.close()
+
         return True
 
     def copyUserDir(self) -> bool:
@@ -442,49 +866,51 @@ class WechatSerializer(AppSerializer):
         if not srcFileStoragePath.exists():
             return True
 
+        manifest = SyncManifest(self.outputDir) if self.incrementalSync else None
+
         # 复制文件到输出目录
         for dirName in dirPicked:
             dirPath = srcFileStoragePath / dirName
             dstPath = dstFileStoragePath / dirName
             dstPath.mkdir(parents=True, exist_ok=True)
-            shutil.copytree(dirPath, dstPath, dirs_exist_ok=True)
+            if dirName == "Image" and self.decodeImageFromSource:
+                # dat文件在下面直接从源目录解密到输出目录，不再复制
+                self._copyDir(dirPath, dstPath, manifest, "*.dat")
+            else:
+                self._copyDir(dirPath, dstPath, manifest)
 
         # 解密image文件夹
         imagePath = dstFileStoragePath / "Image"
-        if not imagePath.exists():
+        datDirPath = srcFileStoragePath / "Image" if self.decodeImageFromSource else imagePath
+        if not datDirPath.exists():
+            if manifest is not None:
+                manifest.save()
             return True
 
-        for filePath in imagePath.glob("**/*.dat"):
-            fileName = filePath.stem + ".jpg"
+        pathPairs = ((filePath, imagePath / (filePath.stem + ".jpg")) for filePath in datDirPath.glob("**/*.dat"))
+        if manifest is not None:
+            pathPairs = [(srcPath, dstPath) for srcPath, dstPath in pathPairs if manifest.isChanged(srcPath, dstPath)]
+            dstPathDict = dict(pathPairs)
+
+        def onDecoded(filePath: pathlib.Path):
             self.callback(False, f"正在解密{filePath.name}")
-            key = 0
-            fr = open(filePath, "rb")
-            fw = open(imagePath / fileName, 'wb+')
-            newFileBytes = bytearray()
-            for line in fr:
-                for b in line:
-                    if key == 0:
-                        key = b ^ 0xff
-                    newFileBytes.append(b ^ key)
-            fw.write(newFileBytes)
-            fr.close()
-            fw.close()
+            if manifest is not None:
+                manifest.update(filePath, dstPathDict[filePath])
+
+        DatDecoder.decodeFiles(pathPairs, self.imageDecodeWorkers, onDecoded)
+
+        if manifest is not None:
+            manifest.save()
         return True
 
     @staticmethod
     def __filterId(idStr: str):
         # id范围 0-9 a-z A-Z _ @ 且匹配连续的字符
-        # return re.sub(r'[^a-zA-Z0-9_@]\w+', '', idStr)
-
-        nonMatchIdx = 0
-
-        for idx, b in enumerate(idStr):
-            if ord(b) in weChatIdRangeList:
-                continue
-            else:
-                nonMatchIdx = idx
-                break
+        nonMatchIdx = weChatIdPattern.match(idStr).end()
 
+        # 与以前一样，全部字符都匹配时返回空字符串
+        if nonMatchIdx == len(idStr):
+            return ""
         return idStr[0:nonMatchIdx]
 
     @staticmethod
@@ -594,6 +1020,91 @@ class WechatSerializer(AppSerializer):
 
         return msgSegmentDict
 
+    @staticmethod
+    def _generateRecordJsonDict(index, msgSegment: WeChatMsgSegment, recordList: List[WeChatRecord]) -> Dict:
+        msgList = []
+        for record in recordList:
+            msgDict = {"Sender": record.sender, "Msg": record.message}
+            if len(record.mediaId) != 0:
+                msgDict["MediaId"] = record.mediaId
+            msgList.append(msgDict)
+
+        return {"Segment": index,
+                "StartTime": Utility.getFormatTime(float(msgSegment.startTime) / 1000),
+                "EndTime": Utility.getFormatTime(float(msgSegment.endTime) / 1000),
+                "Messages": msgList}
+
+
+# 解析进程中使用的全局对象，由_initParseWorker初始化
+_workerSerializer: Union[WechatSerializer, None] = None
+_workerReader: Union[MappedFileReader, None] = None
+
+
+def _initParseWorker(mediaIdList: List[str], structuredText: bool):
+    global _workerSerializer, _workerReader
+    # 解析只依赖mediaDict中是否存在某个mediaId
+    _workerSerializer = WechatSerializer(None)
+    _workerSerializer.mediaDict = dict.fromkeys(mediaIdList)
+    _workerSerializer.structuredText = structuredText
+    _workerReader = MappedFileReader()
+
+
+def _parseSegmentBatch(batch: List[Tuple[str, int, WeChatMsgSegment]]) -> List[Dict]:
+    result = []
+    for bakTextPath, segmentNum, msgSegment in batch:
+        msgSegView = _workerReader.read(bakTextPath, msgSegment.offset, msgSegment.length)
+        result.append(_workerSerializer._parseSegment(segmentNum, msgSegment, msgSegView))
+        msgSegView.release()
+    return result
+
+
+def _writeQQChatJson(jsonPath: pathlib.Path, qqChatList: List["QQChat"]) -> int:
+    jsonObj = []
+    for qqChat in qqChatList:
+        msgFields = TagBlobDecoder.decodeQQMsg(qqChat.msgData)
+        chatMsgDict = {"time": Utility.getFormatTime(float(qqChat.msgTime)),
+                       "msg": decodeUtf8(msgFields.text),
+                       "sender": msgFields.sender,
+                       "receiver": msgFields.receiver}
+
+        if len(qqChat.dbFileResId) != 0:
+            chatMsgDict["resource"] = qqChat.dbFileResId
+        jsonObj.append(chatMsgDict)
+
+    jsonPath.write_text(Utility.getJsonStr(jsonObj), encoding="utf-8")
+    return len(jsonObj)
+
+
+def _extractQQResFiles(dbPathList: List[str], blobColumnList: List[str],
+                       taskList: List[Tuple[int, int, pathlib.Path]], batchSize: int) -> int:
+    """
+    分片自己打开需要的resfile数据库，按rowid批量读取并写入文件
+    :param taskList: [(数据库序号, rowid, 不含后缀的输出路径)]，已按(数据库序号, rowid)排序
+    """
+    fileNum = 0
+    for dbIndex, dbTaskIter in itertools.groupby(taskList, key=lambda task: task[0]):
+        dbTaskList = list(dbTaskIter)
+        dbUtil = SqliteReader(dbPathList[dbIndex])
+        try:
+            for i in range(0, len(dbTaskList), batchSize):
+                batch = dbTaskList[i:i + batchSize]
+                blobRes = dbUtil.exec(f'select rowid, "{blobColumnList[dbIndex]}" from resfile '
+                                      f'where rowid in ({",".join("?" * len(batch))})',
+                                      *[rowId for _, rowId, _ in batch])
+                blobDict = {blobData[0]: blobData[1] for blobData in blobRes}
+
+                for _, rowId, filePathNoExt in batch:
+                    fileBytes = blobDict.get(rowId) or bytes()
+                    if len(fileBytes) == 0:
+                        continue
+
+                    fileExt = Utility.getFileExtByBytes(fileBytes)
+                    pathlib.Path(f"{filePathNoExt}{fileExt}").write_bytes(fileBytes)
+                    fileNum += 1
+        finally:
+            dbUtil.close()
+    return fileNum
+
 
 @dataclass
 class QQChat:
@@ -613,24 +1124,42 @@ class QQSerializer(AppSerializer):
     TABLE_FILE_CONTEXT = 3
 
     BAK_DIR = "MsgBackup"
+    RES_BATCH_SIZE = 500  # 每次从resfile读取的文件数量，不超过SQLite变量个数的上限
 
     def __init__(self, account: Account):
         super(QQSerializer, self).__init__(account)
-        self.resDbUtil: List[DBUtil] = []
+        self.resDbUtil: List[SqliteReader] = []
 
-        self.idMsgDict: Dict[str, List[QQChat]] = {}  # {id : [""]}
+        self.memoryBudget = 1024 ** 3  # 聊天记录在内存中的大致字节数上限，超过后写入临时数据库，0为不限制
+        self.idMsgDict = SpillGroupStore(self.memoryBudget, self.__getChatSize)  # {id : [QQChat]}
         self.idResDict: Dict[str, Dict[str, List[str]]] = {}  # {id: {msgSeq: [resInfoId]}}
         self.fileContextDict: Dict[str, str] = {}  # {resId: dbFileResId}
 
+    def _getStageList(self) -> List[SerializeStage]:
+        # outputJson和extractMedia都要遍历idMsgDict，extractMedia结束时关闭idMsgDict
+        stageList = super(QQSerializer, self)._getStageList()
+        for stage in stageList:
+            if stage.name == "extractMedia":
+                stage.dependList = ["outputJson"]
+        return stageList
+
     def readDatabase(self) -> bool:
         """
         读取msg_n_id时，存储到idMsgDict；读取res_n_id时，存储到idResDict；读取到fileContextDict时，存储到fileContextDict
-        读取到resfile时，将该数据库存储到resDbUtil
+        读取到resfile时，将该数据库存储到resDbUtil。每条聊天记录的dbFileResId在_iterChats中填充。
         """
+        self.idMsgDict.memoryBudget = self.memoryBudget
         backupPath = self.outputDir / self.BAK_DIR
-        for backupDb in backupPath.glob("*"):
-            dbUtil = DBUtil(str(backupDb), autoClose=False)
-            tableRes = dbUtil.exec("select name from sqlite_master where type = 'table'", needResult=False)
+        if self.decryptChannel is None:
+            backupDbIter = backupPath.glob("*")
+        else:
+            # 流式导出时每解密完一个数据库就读取一个
+            backupDbIter = (self.outputDir / relativePath for relativePath in self.decryptChannel.iterFiles()
+                            if relativePath.startswith(f"{self.BAK_DIR}/"))
+
+        for backupDb in backupDbIter:
+            dbUtil = SqliteReader(str(backupDb))
+            tableRes = dbUtil.exec("select name from sqlite_master where type = 'table'")
 
             for tableList in tableRes:
                 tableName = tableList[0]
@@ -641,71 +1170,76 @@ class QQSerializer(AppSerializer):
                 else:
                     self.callback(False, f"正在读取{tableName}")
                     self.__readDatabaseInternal(dbUtil, dbType, tableName)
+            else:
+                dbUtil.close()
 
-        for qqId, QQChatList in self.idMsgDict.items():
-            msgSeqDict = self.idResDict[qqId]
-
-            for qqChat in QQChatList:
-                if qqChat.msgSeq not in msgSeqDict:
-                    continue
-                else:
-                    resInfoIdList = msgSeqDict[qqChat.msgSeq]
-                    for resInfoId in resInfoIdList:
-                        qqChat.dbFileResId.append(self.fileContextDict[resInfoId])
-
+        if self.decryptChannel is not None and not self.decryptChannel.success:
+            self.callback(True, "数据库没有全部解密成功。")
+            return False
         return True
 
-    def outputJson(self) -> bool:
+    def _iterChats(self) -> Iterator[Tuple[str, List[QQChat]]]:
         """
-        把聊天记录转换成Json（按QQ号）
+        按QQ号逐组返回聊天记录，并填充每条记录的dbFileResId；超出内存预算的部分从临时数据库中读回
         """
         for qqId, qqChatList in self.idMsgDict.items():
-            idBakPath = self.outputDir / self.BAK_DIR
-            idBakPath.mkdir(parents=True, exist_ok=True)
-
-            jsonObj = []
+            msgSeqDict = self.idResDict.get(qqId, {})
             for qqChat in qqChatList:
-                chatMsgDict = {"time": Utility.getFormatTime(float(qqChat.msgTime)),
-                               "msg": self._decodeUtf8(
-                                   qqChat.msgData[qqChat.msgData.rfind(0x0a) + 2:qqChat.msgData.rfind(0x4a)]),
-                               "sender": qqChat.msgData[3:8].hex(),
-                               "receiver": qqChat.msgData[9:14].hex()}
+                qqChat.dbFileResId = [self.fileContextDict[resInfoId]
+                                      for resInfoId in msgSeqDict.get(qqChat.msgSeq, [])]
+            yield qqId, qqChatList
 
-                if len(qqChat.dbFileResId) != 0:
-                    chatMsgDict["resource"] = qqChat.dbFileResId
-                jsonObj.append(chatMsgDict)
+    @staticmethod
+    def __getChatSize(qqChat: QQChat) -> int:
+        return len(qqChat.msgData) + 512
 
-            jsonPath = idBakPath / f"chat_{qqId}.json"
-            jsonStr = Utility.getJsonStr(jsonObj)
-            jsonPath.write_text(jsonStr, encoding="utf-8")
+    def outputJson(self) -> bool:
+        """
+        把聊天记录转换成Json（按QQ号）
+        """
+        idBakPath = self.outputDir / self.BAK_DIR
+        idBakPath.mkdir(parents=True, exist_ok=True)
 
-        return True
+        shardIter = ((qqId, (idBakPath / f"chat_{qqId}.json", qqChatList)) for qqId, qqChatList in self._iterChats())
+        return self._runShards(shardIter, _writeQQChatJson, "正在将聊天记录转换成Json...", len(self.idMsgDict)) == 0
 
     def extractMedia(self) -> bool:
         """
-        从数据库读取图片
+        从数据库读取图片。先一次性建立resId到(数据库, rowid)的索引，再按rowid顺序批量读取文件内容
         """
-        for qqId, qqChatList in self.idMsgDict.items():
-            self.callback(False, f"正在提取{qqId}中的文件...")
+        self.callback(False, "正在建立文件索引...")
+        resIndexDict = self.__buildResIndex()
+
+        # 每个QQ号是一个分片，分片内按(数据库序号, rowid)排序
+        shardList: List[Tuple[str, List[Tuple[int, int, pathlib.Path]]]] = []
+        for qqId, qqChatList in self._iterChats():
             idBakPath = self.outputDir / self.BAK_DIR / qqId
             idBakPath.mkdir(parents=True, exist_ok=True)
+            taskList: List[Tuple[int, int, pathlib.Path]] = []  # [(数据库序号, rowid, 不含后缀的输出路径)]
 
             for qqChat in qqChatList:
-                if len(qqChat.dbFileResId) == 0:
-                    continue
                 for resId in qqChat.dbFileResId:
-                    fileBytes = self.__queryResById(resId)
-                    if len(fileBytes) == 0:
+                    if resId not in resIndexDict:
+                        log.d(f"All db not found {resId}")
                         continue
+                    dbIndex, rowId = resIndexDict[resId]
+                    taskList.append((dbIndex, rowId, idBakPath / resId))
 
-                    fileExt = Utility.getFileExtByBytes(fileBytes)
-                    filePath = idBakPath / f"{resId}{fileExt}"
-                    filePath.write_bytes(fileBytes)
+            if len(taskList) != 0:
+                taskList.sort(key=lambda task: task[0:2])
+                shardList.append((qqId, taskList))
+
+        dbPathList = [dbUtil.dbName for dbUtil in self.resDbUtil]
+        blobColumnList = [self.__getResBlobColumn(dbUtil) for dbUtil in self.resDbUtil]
+        errorNum = self._runShards(((qqId, (dbPathList, blobColumnList, taskList, self.RES_BATCH_SIZE))
+                                    for qqId, taskList in shardList),
+                                   _extractQQResFiles, "正在提取文件...", len(shardList))
 
         for dbUtil in self.resDbUtil:
             dbUtil.close()
+        self.idMsgDict.close()
 
-        return True
+        return errorNum == 0
 
     def copyUserDir(self) -> bool:
         """
@@ -723,14 +1257,14 @@ class QQSerializer(AppSerializer):
         elif tableName == "filecontext":
             return self.TABLE_FILE_CONTEXT
 
-    def __readDatabaseInternal(self, dbUtil: DBUtil, dbType: int, tableName: str):
-        _, execData = dbUtil.exec(f"select * from {tableName}")
+    def __readDatabaseInternal(self, dbUtil: SqliteReader, dbType: int, tableName: str):
+        execData = dbUtil.iterRows(f"select * from {tableName}")
         if dbType == self.TABLE_MSG:
             for msgData in execData:
-                # msgData[7]应该是QByteArray
+                # msgData[7]是消息内容的BLOB
                 qqId = msgData[2]
-                qqChat = QQChat(msgData[0], msgData[7].data(), msgData[5], msgData[2], msgData[4], [])
-                Utility.addListInDict(self.idMsgDict, qqId, qqChat)
+                qqChat = QQChat(msgData[0], msgData[7] or bytes(), msgData[5], msgData[2], msgData[4], [])
+                self.idMsgDict.add(qqId, qqChat)
         elif dbType == self.TABLE_RES:
             qqId = tableName.split("_")[-1]
             if qqId not in self.idResDict.keys():
@@ -747,16 +1281,23 @@ class QQSerializer(AppSerializer):
                 dbFileResId = fileContext[11]
                 self.fileContextDict[resId] = dbFileResId
 
-    def __queryResById(self, resId: str) -> bytes:
-        for dbUtil in self.resDbUtil:
-            execRes, execData = dbUtil.exec("select * from resfile where resId = ?", resId)
-            if not execRes:
-                continue
-            else:
-                return execData[0][1].data()
+    def __buildResIndex(self) -> Dict[str, Tuple[int, int]]:
+        """
+        遍历一次所有resfile数据库，返回{resId: (数据库序号, rowid)}；多个数据库中都存在时，使用靠前的数据库
+        """
+        resIndexDict: Dict[str, Tuple[int, int]] = {}
+        for dbIndex, dbUtil in enumerate(self.resDbUtil):
+            resData = dbUtil.exec("select resId, rowid from resfile")
+            for resId, rowId in resData:
+                if resId not in resIndexDict:
+                    resIndexDict[resId] = (dbIndex, rowId)
+        return resIndexDict
 
-        log.d(f"All db not found {resId}")
-        return bytes()
+    @staticmethod
+    def __getResBlobColumn(dbUtil: SqliteReader) -> str:
+        # 文件内容是resfile的第二列
+        columnData = dbUtil.exec("pragma table_info(resfile)")
+        return columnData[1][1]
 
 
 @dataclass
@@ -767,63 +1308,120 @@ class WeComMessage:
     content: bytes
 
 
+def _writeWeComJson(jsonPath: pathlib.Path, rowList: List[Tuple[str, str, bytes, bool]]) -> int:
+    """
+    :param rowList: [(发送者名称, 发送时间, content, content是否需要解析)]
+    """
+    jsonObj = []
+    for sender, sendTime, content, needDecode in rowList:
+        if needDecode:
+            content = TagBlobDecoder.decodeWeComContent(content)
+        jsonObj.append({
+            "Sender": sender,
+            "Time": Utility.getFormatTime(float(sendTime)),
+            "Content": decodeUtf8(content)
+        })
+    jsonPath.write_text(Utility.getJsonStr(jsonObj), encoding="utf-8")
+    return len(jsonObj)
+
+
 # noinspection SqlResolve
 class WeComSerializer(AppSerializer):
     def __init__(self, account: Account):
         super(WeComSerializer, self).__init__(account)
-        self.messageDict: Dict[str, List[WeComMessage]] = {}  # conversationId:WeComMessage
+        self.streamConversations = True  # 由SQLite按会话排序，outputJson时每次只读取一个会话的消息
+        self.memoryBudget = 1024 ** 3  # 消息在内存中的大致字节数上限，超过后写入临时数据库，0为不限制
+        self.messageDict = SpillGroupStore(self.memoryBudget, self.__getMessageSize)  # conversationId:[WeComMessage]
         self.contactDict: Dict[str, str] = {}  # WeComId:Name
         self.serviceDict: Dict[str, str] = {}  # ServiceConversationId : Name
 
     def readDatabase(self) -> bool:
         dbNames = ["decrypt_" + dbName for dbName in ["message.db", "user.db", "session.db"]]
         for dbName in dbNames:
-            if not (self.outputDir / dbName).exists():
+            if not self._waitDecrypted(dbName) or not (self.outputDir / dbName).exists():
                 self.callback(True, "数据库解密不完整。")
                 return False
 
-        dbMessage = DBUtil(str((self.outputDir / dbNames[0]).resolve()))
-        dbUser = DBUtil(str((self.outputDir / dbNames[1]).resolve()))
-        dbSession = DBUtil(str((self.outputDir / dbNames[2]).resolve()))
+        self.messageDict.memoryBudget = self.memoryBudget
+        dbMessage = SqliteReader(str((self.outputDir / dbNames[0]).resolve()))
+        dbUser = SqliteReader(str((self.outputDir / dbNames[1]).resolve()))
+        dbSession = SqliteReader(str((self.outputDir / dbNames[2]).resolve()))
 
-        self.callback(False, "正在读取Message.db...")
-        execRes, dataRes = dbMessage.exec("select conversation_id, sender_id, send_time, content "
-                                          "from message_table order by send_time")
-        for data in dataRes:
-            msg = WeComMessage(data[0], str(data[1]), data[2], data[3].data())
-            Utility.addListInDict(self.messageDict, msg.conversationId, msg)
+        if not self.streamConversations:
+            self.callback(False, "正在读取Message.db...")
+            dataRes = dbMessage.iterRows("select conversation_id, sender_id, send_time, content "
+                                         "from message_table order by send_time")
+            for data in dataRes:
+                msg = WeComMessage(data[0], str(data[1]), data[2], data[3] or bytes())
+                self.messageDict.add(msg.conversationId, msg)
 
         self.callback(False, "正在读取User.db...")
-        execRes, dataRes = dbUser.exec("select id, name from user_table")
+        dataRes = dbUser.iterRows("select id, name from user_table")
         for data in dataRes:
             self.contactDict[str(data[0])] = data[1]
 
         self.callback(False, "正在读取Session.db...")
-        execRes, dataRes = dbSession.exec("select id, name from conversation_table where length(name) > 0")
+        dataRes = dbSession.iterRows("select id, name from conversation_table where length(name) > 0")
         for data in dataRes:
             self.serviceDict[data[0]] = data[1]
 
+        dbMessage.close()
+        dbUser.close()
+        dbSession.close()
         return True
 
     def outputJson(self) -> bool:
-        for conversationId, weComMsgList in self.messageDict.items():
-            self.callback(False, f"正在将{conversationId}聊天记录序列化...")
-            jsonObj = []
+        errorNum = self._runShards(self.__iterJsonShards(), _writeWeComJson, "正在将聊天记录序列化...")
+        self.messageDict.close()
+        return errorNum == 0
+
+    def __iterJsonShards(self) -> Iterator[Tuple[str, tuple]]:
+        """
+        在当前线程中查好发送者名称，分片只需要处理消息内容。
+        会话名称重复时，后出现的会话文件名加上去掉"S:"、"R:"等前缀的conversationId，避免并行写入同一个文件。
+        文件名中不能有冒号，否则在NTFS上会写入备用数据流，会话文件不会出现。
+        """
+        chatNameSet = set()
+        for conversationId, weComMsgList in self._iterConversations():
             chatType = self.__getChatType(conversationId)
             chatName = self.__getChatName(conversationId)
+            if chatName in chatNameSet:
+                chatName = f"{chatName}_{conversationId[2:]}"
+            chatNameSet.add(chatName)
 
-            for weComMsg in weComMsgList:
-                msgStart = weComMsg.content.rfind(0x0a) + 1 if chatType != 2 else 0
-
-                jsonObj.append({
-                    "Sender": self.contactDict.get(weComMsg.senderId, "未知用户") if chatType != 2
-                    else self.serviceDict.get(weComMsg.conversationId, "未知服务号"),
-                    "Time": Utility.getFormatTime(float(weComMsg.sendTime)),
-                    "Content": self._decodeUtf8(weComMsg.content[msgStart:])
-                })
-            jsonPath = self.outputDir / (chatName + ".json")
-            jsonPath.write_text(Utility.getJsonStr(jsonObj), encoding="utf-8")
-        return True
+            rowList = [(self.contactDict.get(weComMsg.senderId, "未知用户") if chatType != 2
+                        else self.serviceDict.get(weComMsg.conversationId, "未知服务号"),
+                        weComMsg.sendTime, weComMsg.content, chatType != 2)
+                       for weComMsg in weComMsgList]
+            yield conversationId, (self.outputDir / (chatName + ".json"), rowList)
+
+    def _iterConversations(self) -> Iterator[Tuple[str, List[WeComMessage]]]:
+        """
+        逐个返回会话及其按时间排序的消息。
+        streamConversations为True时，在临时表中对(conversation_id, send_time)建立索引，按索引顺序从Message.db中读取，
+        内存中只有一个会话的消息；否则返回readDatabase中读取的messageDict。
+        """
+        if not self.streamConversations:
+            yield from self.messageDict.items()
+            return
+
+        dbMessage = SqliteReader(str((self.outputDir / "decrypt_message.db").resolve()))
+        try:
+            dbMessage.createTempIndex("MessageOrder",
+                                      "select rowid as msgRowId, conversation_id, send_time from message_table",
+                                      ["conversation_id", "send_time", "msgRowId"])
+            dataRes = dbMessage.iterRows("select m.conversation_id, m.sender_id, m.send_time, m.content "
+                                         "from temp.MessageOrder o join message_table m on m.rowid = o.msgRowId "
+                                         "order by o.conversation_id, o.send_time")
+            for conversationId, dataGroup in itertools.groupby(dataRes, key=lambda data: data[0]):
+                yield conversationId, [WeComMessage(data[0], str(data[1]), data[2], data[3] or bytes())
+                                       for data in dataGroup]
+        finally:
+            dbMessage.close()
+
+    @staticmethod
+    def __getMessageSize(weComMsg: WeComMessage) -> int:
+        return len(weComMsg.content) + 512
 
     def extractMedia(self) -> bool:
         return True
@@ -836,13 +1434,17 @@ class WeComSerializer(AppSerializer):
         if not srcFileStoragePath.exists():
             return True
 
+        manifest = SyncManifest(self.outputDir) if self.incrementalSync else None
+
         # 复制文件到输出目录
         for dirName in dirPicked:
             dirPath = srcFileStoragePath / dirName
             dstPath = dstFileStoragePath / dirName
             dstPath.mkdir(parents=True, exist_ok=True)
-            shutil.copytree(dirPath, dstPath, dirs_exist_ok=True)
+            self._copyDir(dirPath, dstPath, manifest)
 
+        if manifest is not None:
+            manifest.save()
         return True
 
     def __getChatType(self, convId: str):
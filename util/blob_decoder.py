@@ -0,0 +1,171 @@
+"""
+解析QQ的msgData和企业微信的content。两者都是tag + varint长度前缀的结构（与protobuf的编码方式相同），
+只沿已知的字段路径逐层查找，跳过其它字段的内容，每个字节最多读取一次；结果是memoryview切片，不产生中间拷贝。
+无法按结构解析时，退回到以前按0x0a、0x4a截取的方式。
+"""
+
+from dataclasses import dataclass
+from typing import List, Tuple, Union
+
+WIRE_VARINT = 0
+WIRE_64BIT = 1
+WIRE_LENGTH = 2
+WIRE_32BIT = 5
+
+MAX_DEPTH = 8  # 嵌套解析的最大深度（微信聊天记录）
+
+# (fieldNo, wireType, tagStart, valueStart, valueEnd)
+Field = Tuple[int, int, int, int, int]
+
+
+@dataclass
+class QQMsgFields:
+    text: memoryview
+    sender: str
+    receiver: str
+
+
+class TagBlobDecoder:
+    @staticmethod
+    def readVarint(mv: Union[bytes, memoryview], pos: int, end: int) -> Tuple[int, int]:
+        """
+        :return: (值, varint之后的位置)；越界或超过64位时返回(-1, -1)
+        """
+        if pos >= end:
+            return -1, -1
+        # 绝大多数tag和长度只有一个字节
+        b = mv[pos]
+        if b < 0x80:
+            return b, pos + 1
+
+        result = 0
+        shift = 0
+        while pos < end and shift < 64:
+            b = mv[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                return result, pos
+            shift += 7
+        return -1, -1
+
+    @staticmethod
+    def parseFields(mv: memoryview, start: int, end: int) -> Union[List[Field], None]:
+        """
+        把mv[start:end]完整地解析为同一层的字段列表，不能恰好解析到end时返回None
+        """
+        fields: List[Field] = []
+        pos = start
+        while pos < end:
+            tag, valueStart = TagBlobDecoder.readVarint(mv, pos, end)
+            if tag <= 0 or (tag >> 3) == 0:
+                return None
+            fieldNo, wireType = tag >> 3, tag & 0x07
+
+            if wireType == WIRE_VARINT:
+                _, valueEnd = TagBlobDecoder.readVarint(mv, valueStart, end)
+            elif wireType == WIRE_LENGTH:
+                length, valueStart = TagBlobDecoder.readVarint(mv, valueStart, end)
+                valueEnd = valueStart + length if length >= 0 else -1
+            elif wireType == WIRE_64BIT:
+                valueEnd = valueStart + 8
+            elif wireType == WIRE_32BIT:
+                valueEnd = valueStart + 4
+            else:
+                return None
+
+            if valueEnd < 0 or valueEnd > end:
+                return None
+            fields.append((fieldNo, wireType, pos, valueStart, valueEnd))
+            pos = valueEnd
+        return fields
+
+    @staticmethod
+    def findLengthField(mv: Union[bytes, memoryview], fieldNo: int, nextFieldNo: Union[int, None] = None,
+                        start=0, end=None, anyPosition=False) -> Union[Field, None]:
+        """
+        在mv[start:end]这一层中查找最后一个编号为fieldNo的长度前缀字段，只读取各字段的tag和长度，不进入字段内容。
+        nextFieldNo不为None时，要求紧跟着编号为nextFieldNo的字段；为None时，要求该字段是这一层的最后一个字段。
+        anyPosition为True时不限制该字段的位置。这一层不能恰好解析到end时返回None。
+        """
+        end = len(mv) if end is None else end
+        readVarint = TagBlobDecoder.readVarint
+        result = None
+        previous = None  # 上一个编号为fieldNo的长度前缀字段，等待确认下一个字段的编号
+        pos = start
+        while pos < end:
+            # 单字节的tag和长度直接读取，不调用readVarint
+            tag = mv[pos]
+            valueStart = pos + 1
+            if tag >= 0x80:
+                tag, valueStart = readVarint(mv, pos, end)
+            currentNo, wireType = tag >> 3, tag & 0x07
+            if currentNo == 0:
+                return None
+
+            if wireType == WIRE_LENGTH:
+                if valueStart >= end:
+                    return None
+                length = mv[valueStart]
+                if length < 0x80:
+                    valueStart += 1
+                else:
+                    length, valueStart = readVarint(mv, valueStart, end)
+                    if length < 0:
+                        return None
+                valueEnd = valueStart + length
+            elif wireType == WIRE_VARINT:
+                # 只跳过，不计算值
+                valueEnd = valueStart
+                while valueEnd < end and mv[valueEnd] >= 0x80:
+                    valueEnd += 1
+                valueEnd += 1
+            elif wireType == WIRE_64BIT:
+                valueEnd = valueStart + 8
+            elif wireType == WIRE_32BIT:
+                valueEnd = valueStart + 4
+            else:
+                return None
+            if valueEnd > end:
+                return None
+
+            if previous is not None and currentNo == nextFieldNo:
+                result = previous
+            if currentNo == fieldNo and wireType == WIRE_LENGTH:
+                previous = (currentNo, wireType, pos, valueStart, valueEnd)
+                if anyPosition:
+                    result = previous
+            else:
+                previous = None
+            pos = valueEnd
+
+        if nextFieldNo is None and not anyPosition:
+            return previous
+        return result
+
+    @staticmethod
+    def decodeQQMsg(msgData: bytes) -> QQMsgFields:
+        """
+        消息体是顶层的字段3，其中消息文本是字段1，后面紧跟字段9；发送者和接收者是开头固定位置的varint，与以前一样输出其原始字节的十六进制
+        """
+        mv = memoryview(msgData)
+        text = None
+        body = TagBlobDecoder.findLengthField(msgData, 3, anyPosition=True)
+        if body is not None:
+            field = TagBlobDecoder.findLengthField(msgData, 1, 9, body[3], body[4])
+            if field is not None:
+                text = mv[field[3]:field[4]]
+        if text is None:
+            text = mv[msgData.rfind(0x0a) + 2:msgData.rfind(0x4a)]
+        return QQMsgFields(text, mv[3:8].hex(), mv[9:14].hex())
+
+    @staticmethod
+    def decodeWeComContent(content: bytes) -> memoryview:
+        """
+        消息文本是顶层位于末尾的字段1
+        """
+        mv = memoryview(content)
+        field = TagBlobDecoder.findLengthField(content, 1)
+        if field is not None:
+            return mv[field[3]:field[4]]
+        return mv[content.rfind(0x0a) + 1:]
@@ -0,0 +1,84 @@
+"""
+解密微信FileStorage/Image下的dat图片文件。dat文件是图片的每个字节与同一个key异或得到的。
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os import PathLike
+from typing import Dict, Iterable, List, Tuple, Callable
+
+CHUNK_SIZE = 1024 * 1024
+
+# 常见图片的文件头，用于推算key
+imageHeaderList = [
+    bytes([0xff, 0xd8, 0xff]),  # jpg
+    bytes([0x89, 0x50, 0x4e, 0x47]),  # png
+    bytes([0x47, 0x49, 0x46, 0x38]),  # gif
+]
+
+
+class DatDecoder:
+    _tableDict: Dict[int, bytes] = {}  # {key: 256字节的异或转换表}
+
+    @staticmethod
+    def detectKey(header: bytes) -> int:
+        """
+        用文件头与已知图片文件头比对得到key，都不匹配时与以前一样按jpg计算
+        """
+        for imageHeader in imageHeaderList:
+            if len(header) < len(imageHeader):
+                continue
+            key = header[0] ^ imageHeader[0]
+            if all(header[i] ^ key == imageHeader[i] for i in range(1, len(imageHeader))):
+                return key
+
+        return header[0] ^ 0xff if len(header) != 0 else 0
+
+    @staticmethod
+    def getTable(key: int) -> bytes:
+        table = DatDecoder._tableDict.get(key)
+        if table is None:
+            table = DatDecoder._tableDict[key] = bytes(b ^ key for b in range(256))
+        return table
+
+    @staticmethod
+    def decodeFile(srcPath: PathLike, dstPath: PathLike):
+        """
+        按CHUNK_SIZE分块解密，内存占用与文件大小无关。dstPath已存在时先删除，它可能是上一次导出的硬链接
+        """
+        try:
+            os.remove(dstPath)
+        except FileNotFoundError:
+            pass
+        with open(srcPath, 'rb') as fr, open(dstPath, 'wb') as fw:
+            chunk = fr.read(CHUNK_SIZE)
+            table = DatDecoder.getTable(DatDecoder.detectKey(chunk[0:4]))
+            while len(chunk) != 0:
+                fw.write(chunk.translate(table))
+                chunk = fr.read(CHUNK_SIZE)
+
+    @staticmethod
+    def decodeFiles(pathPairs: Iterable[Tuple[PathLike, PathLike]], workers: int,
+                    callback: Callable[[PathLike], None] = None):
+        """
+        使用线程池解密多个文件，每解密完一个文件回调一次callback(srcPath)。
+        不同目录下的同名dat会解密到同一个dstPath，这些文件放在同一个任务中按顺序解密，结果与依次解密相同
+        :param pathPairs: (srcPath, dstPath)
+        """
+        srcPathListDict: Dict[str, List[PathLike]] = {}  # {dstPath: [srcPath]}
+        dstPathDict: Dict[str, PathLike] = {}
+        for srcPath, dstPath in pathPairs:
+            srcPathListDict.setdefault(os.path.normcase(dstPath), []).append(srcPath)
+            dstPathDict[os.path.normcase(dstPath)] = dstPath
+
+        def decodeGroup(key: str):
+            for srcPath in srcPathListDict[key]:
+                DatDecoder.decodeFile(srcPath, dstPathDict[key])
+
+        with ThreadPoolExecutor(workers) as executor:
+            futureDict = {executor.submit(decodeGroup, key): key for key in srcPathListDict}
+            for future in as_completed(futureDict):
+                future.result()
+                if callback is not None:
+                    for srcPath in srcPathListDict[futureDict[future]]:
+                        callback(srcPath)
@@ -0,0 +1,75 @@
+"""
+流式导出时，DecryptThread每解密完一个文件就通知序列化线程，需要该文件的阶段可以立即开始，不必等待全部文件解密完成。
+"""
+
+import pathlib
+import threading
+from os import PathLike
+from typing import List, Iterator, Union
+
+
+class DecryptedFileChannel:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.fileList: List[str] = []  # 已解密的文件，相对输出目录的路径，按完成顺序
+        self.fileSet = set()
+        self.closed = False  # 解密线程已经结束
+        self.success = False  # 全部文件解密成功
+
+    @staticmethod
+    def normalize(relativePath: Union[str, PathLike]) -> str:
+        return pathlib.PurePath(relativePath).as_posix()
+
+    def publish(self, relativePath: Union[str, PathLike]):
+        """
+        :param relativePath: 已解密文件相对输出目录的路径
+        """
+        relativePath = self.normalize(relativePath)
+        with self.condition:
+            if relativePath not in self.fileSet:
+                self.fileSet.add(relativePath)
+                self.fileList.append(relativePath)
+            self.condition.notify_all()
+
+    def close(self, success: bool):
+        """
+        解密线程结束时调用，重复调用时以第一次为准
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.success = success
+            self.condition.notify_all()
+
+    def waitFile(self, relativePath: Union[str, PathLike], timeout: float = None) -> bool:
+        """
+        等待文件解密完成
+        :return: 文件是否已解密；解密线程结束时仍没有该文件或超时返回False
+        """
+        relativePath = self.normalize(relativePath)
+        with self.condition:
+            return self.condition.wait_for(lambda: relativePath in self.fileSet or self.closed, timeout) and \
+                relativePath in self.fileSet
+
+    def waitClosed(self, timeout: float = None) -> bool:
+        """
+        :return: 全部文件是否解密成功
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed, timeout)
+            return self.closed and self.success
+
+    def iterFiles(self) -> Iterator[str]:
+        """
+        按完成顺序逐个返回已解密的文件，没有新文件时等待，解密线程结束后停止
+        """
+        index = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: index < len(self.fileList) or self.closed)
+                if index >= len(self.fileList):
+                    return
+                relativePath = self.fileList[index]
+            index += 1
+            yield relativePath
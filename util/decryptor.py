@@ -0,0 +1,202 @@
+"""
+解密器接口及解密任务的线程池。CppDecryptor调用DataCollectUtil.dll；PyDecryptor是纯Python的替身，只用于在没有dll的环境中测试流程。
+"""
+
+import os
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import BinaryIO, Callable, List, Tuple
+
+from util import log
+
+HEADER_STRIP_CHUNK_SIZE = 1024 * 1024
+
+
+class Decryptor(ABC):
+    """
+    返回值与dll相同：0为成功
+    """
+
+    @abstractmethod
+    def decryptWeChatBackupDb(self, backupDir: str, fileName: str, outputDir: str, bakKey: str) -> int:
+        """
+        解密backupDir/fileName，写入outputDir/decrypt_fileName
+        """
+        pass
+
+    @abstractmethod
+    def decryptWeChatBackupFile(self, backupDir: str, fileName: str, outputDir: str, bakKey: str) -> int:
+        """
+        解密backupDir/fileName，写入outputDir/decrypt_fileName
+        """
+        pass
+
+    @abstractmethod
+    def decryptQQDb(self, dllPath: str, dbPath: str, key: bytearray) -> int:
+        """
+        原地解密dbPath，解密后的文件前1024字节是空的文件头
+        """
+        pass
+
+
+class CppDecryptor(Decryptor):
+    def __init__(self):
+        # 只有Windows有windll，用到时再加载
+        from util.cpp_lib import CppLibrary
+        self.cppLib = CppLibrary()
+
+    def decryptWeChatBackupDb(self, backupDir: str, fileName: str, outputDir: str, bakKey: str) -> int:
+        return self.cppLib.decryptWeChatBackupDb(backupDir, fileName, outputDir, bakKey)
+
+    def decryptWeChatBackupFile(self, backupDir: str, fileName: str, outputDir: str, bakKey: str) -> int:
+        return self.cppLib.decryptWeChatBackupFile(backupDir, fileName, outputDir, bakKey)
+
+    def decryptQQDb(self, dllPath: str, dbPath: str, key: bytearray) -> int:
+        return self.cppLib.decryptQQDb(dllPath, dbPath, key)
+
+
+class PyDecryptor(Decryptor):
+    """
+    用key循环异或代替真正的解密算法，加密和解密是同一个操作，可以用来生成测试数据
+    """
+
+    def decryptWeChatBackupDb(self, backupDir: str, fileName: str, outputDir: str, bakKey: str) -> int:
+        return self.__xorFile(os.path.join(backupDir, fileName), os.path.join(outputDir, f"decrypt_{fileName}"),
+                              bakKey.encode())
+
+    def decryptWeChatBackupFile(self, backupDir: str, fileName: str, outputDir: str, bakKey: str) -> int:
+        return self.__xorFile(os.path.join(backupDir, fileName), os.path.join(outputDir, f"decrypt_{fileName}"),
+                              bakKey.encode())
+
+    def decryptQQDb(self, dllPath: str, dbPath: str, key: bytearray) -> int:
+        return self.__xorFile(dbPath, dbPath, bytes(key))
+
+    @staticmethod
+    def __xorFile(srcPath: str, dstPath: str, key: bytes) -> int:
+        if not os.path.exists(srcPath):
+            return 1
+        if len(key) == 0:
+            return 2
+
+        # 分块大小是key长度的整数倍，每块都从key的开头异或
+        chunkSize = HEADER_STRIP_CHUNK_SIZE // len(key) * len(key) or len(key)
+        keyInt = int.from_bytes(key * (chunkSize // len(key)), "little")
+        with open(srcPath, 'rb') as fr, open(dstPath, 'r+b' if srcPath == dstPath else 'wb') as fw:
+            while True:
+                chunk = fr.read(chunkSize)
+                if len(chunk) == 0:
+                    break
+                mask = keyInt & ((1 << (8 * len(chunk))) - 1)
+                if srcPath == dstPath:
+                    fw.seek(fr.tell() - len(chunk))
+                fw.write((int.from_bytes(chunk, "little") ^ mask).to_bytes(len(chunk), "little"))
+        return 0
+
+
+def stripHeader(srcPath: str, dstPath: str, headerSize: int = 1024, inPlace=True) -> float:
+    """
+    去掉srcPath的前headerSize字节，结果保存为dstPath，srcPath不再保留。按HEADER_STRIP_CHUNK_SIZE分块处理，内存占用固定。
+    :param inPlace: 在原文件中把内容前移后截断再重命名，磁盘上不会同时存在两份数据库；
+                    False时复制到dstPath，优先使用copy_file_range在内核中复制
+    :return: 吞吐量（MB/s）
+    """
+    start = time.perf_counter()
+    dataSize = max(os.path.getsize(srcPath) - headerSize, 0)
+
+    if inPlace:
+        _shiftFile(srcPath, headerSize)
+        os.replace(srcPath, dstPath)
+    else:
+        with open(srcPath, 'rb') as fr, open(dstPath, 'wb', buffering=0) as fw:
+            _copyRange(fr, fw, headerSize, dataSize)
+        os.remove(srcPath)
+
+    useTime = time.perf_counter() - start
+    throughput = dataSize / 1024 ** 2 / useTime if useTime > 0 else 0.0
+    log.i(f"去掉{os.path.basename(dstPath)}的文件头: {dataSize / 1024 ** 2:.1f}MB, "
+          f"{useTime:.2f}s, {throughput:.1f}MB/s, {'原地' if inPlace else '复制'}")
+    return throughput
+
+
+def _shiftFile(path: str, shift: int):
+    """
+    把文件内容整体前移shift字节并截断。每块都是先读后写，写入位置总在读取位置之前，不会覆盖还没读取的内容
+    """
+    buffer = bytearray(HEADER_STRIP_CHUNK_SIZE)
+    bufferView = memoryview(buffer)
+    with open(path, 'r+b', buffering=0) as f:
+        readPos = shift
+        writePos = 0
+        while True:
+            f.seek(readPos)
+            readLen = f.readinto(bufferView)
+            if readLen == 0:
+                break
+            f.seek(writePos)
+            written = 0
+            while written < readLen:  # 无缓冲写入可能只写入一部分
+                written += f.write(bufferView[written:readLen])
+            readPos += readLen
+            writePos += readLen
+        f.truncate(writePos)
+    bufferView.release()
+
+
+def _copyRange(fr: BinaryIO, fw: BinaryIO, offset: int, length: int):
+    copyFileRange = getattr(os, "copy_file_range", None)
+    if copyFileRange is not None:
+        try:
+            while length > 0:
+                copied = copyFileRange(fr.fileno(), fw.fileno(), length, offset)
+                if copied == 0:
+                    return
+                offset += copied
+                length -= copied
+            return
+        except OSError:  # 不支持的文件系统，分块复制剩余部分
+            pass
+
+    fr.seek(offset)
+    while length > 0:
+        chunk = fr.read(min(HEADER_STRIP_CHUNK_SIZE, length))
+        if len(chunk) == 0:
+            break
+        fw.write(chunk)
+        length -= len(chunk)
+
+
+def runDecryptTasks(taskList: List[Tuple[str, Callable[[], int]]], workers: int,
+                    onDone: Callable[[str, int], None] = None) -> Tuple[str, int]:
+    """
+    执行互相独立的解密任务。ctypes调用dll时会释放GIL，多个文件可以在线程池中同时解密。
+    有任务失败后不再开始新的任务，已经开始的任务执行完毕后返回。
+    :param taskList: [(文件名, 返回错误码的解密函数)]
+    :param workers: 同时解密的文件数，1为依次解密
+    :param onDone: 每个任务完成后在当前线程中调用onDone(文件名, 错误码)
+    :return: 第一个失败任务的(文件名, 错误码)，全部成功时为("", 0)
+    """
+    failure = ("", 0)
+    if workers <= 1:
+        for name, task in taskList:
+            result = task()
+            if onDone is not None:
+                onDone(name, result)
+            if result != 0:
+                return name, result
+        return failure
+
+    with ThreadPoolExecutor(workers) as executor:
+        futureDict = {executor.submit(task): name for name, task in taskList}
+        for future in as_completed(futureDict):
+            if future.cancelled():
+                continue
+            name = futureDict[future]
+            result = future.result()
+            if onDone is not None:
+                onDone(name, result)
+            if result != 0 and failure[1] == 0:
+                failure = (name, result)
+                for otherFuture in futureDict:
+                    otherFuture.cancel()
+    return failure
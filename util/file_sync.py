@@ -0,0 +1,126 @@
+"""
+增量同步用户目录：在输出目录中保存每个输出文件对应源文件的大小、修改时间和可选的哈希，只复制或解密新增及变化的文件。
+"""
+
+import errno
+import fnmatch
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+from os import PathLike
+from typing import Dict, List, Tuple, Union
+
+MANIFEST_NAME = ".sync_manifest.json"
+
+
+class SyncManifest:
+    def __init__(self, outputDir: PathLike, useHash=False):
+        """
+        :param outputDir: 输出目录，清单保存在该目录下
+        :param useHash: 大小相同但修改时间变化时，是否再比较文件哈希
+        """
+        self.outputDir = pathlib.Path(outputDir)
+        self.path = self.outputDir / MANIFEST_NAME
+        self.useHash = useHash
+        self.entryDict: Dict[str, List] = {}  # {输出文件相对路径: [size, mtimeNs, hash]}
+
+        if self.path.exists():
+            try:
+                self.entryDict = json.loads(self.path.read_text(encoding="utf-8"))
+            except ValueError:
+                self.entryDict = {}
+
+    def isChanged(self, srcPath: PathLike, dstPath: PathLike) -> bool:
+        """
+        srcPath与上次同步到dstPath时相比是否发生变化，dstPath不存在也认为发生了变化
+        """
+        entry = self.entryDict.get(self.__getKey(dstPath))
+        if entry is None or not os.path.exists(dstPath):
+            return True
+
+        stat = os.stat(srcPath)
+        if entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return False
+
+        if self.useHash and entry[0] == stat.st_size and entry[2] == self.__getFileHash(srcPath):
+            entry[1] = stat.st_mtime_ns
+            return False
+
+        return True
+
+    def update(self, srcPath: PathLike, dstPath: PathLike):
+        stat = os.stat(srcPath)
+        fileHash = self.__getFileHash(srcPath) if self.useHash else None
+        self.entryDict[self.__getKey(dstPath)] = [stat.st_size, stat.st_mtime_ns, fileHash]
+
+    def save(self):
+        self.path.write_text(json.dumps(self.entryDict), encoding="utf-8")
+
+    def syncTree(self, srcDir: PathLike, dstDir: PathLike, ignorePattern: Union[str, None] = None):
+        """
+        与shutil.copytree(dirs_exist_ok=True)相同，但只复制新增及变化的文件
+        """
+        if not os.path.isdir(srcDir):
+            raise FileNotFoundError(f"{srcDir}不存在")
+
+        for root, _, fileNames in os.walk(srcDir):
+            dstRoot = pathlib.Path(dstDir) / os.path.relpath(root, srcDir)
+            dstRoot.mkdir(parents=True, exist_ok=True)
+            for fileName in fileNames:
+                if ignorePattern is not None and fnmatch.fnmatch(fileName, ignorePattern):
+                    continue
+                srcPath = os.path.join(root, fileName)
+                dstPath = dstRoot / fileName
+                if self.isChanged(srcPath, dstPath):
+                    # dstPath可能是上一次导出的硬链接，先删除，不改写上一次导出中的文件
+                    if dstPath.exists():
+                        dstPath.unlink()
+                    shutil.copy2(srcPath, dstPath)
+                    self.update(srcPath, dstPath)
+
+    def __getKey(self, dstPath: PathLike) -> str:
+        return os.path.relpath(dstPath, self.outputDir)
+
+    @staticmethod
+    def __getFileHash(path: PathLike) -> str:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as fr:
+            for chunk in iter(lambda: fr.read(1024 * 1024), b""):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+
+def linkTree(srcDir: PathLike, dstDir: PathLike) -> Tuple[int, int]:
+    """
+    与shutil.copytree(dirs_exist_ok=True)相同，但同一个卷上的文件使用硬链接，不复制内容；跨卷或不支持硬链接时复制。
+    dstDir中已存在的文件先删除再链接，不会通过旧的硬链接改写其它位置的文件。
+    链接后的文件与srcDir中的文件是同一份数据，只能以只读方式使用。
+    :return: (硬链接的文件数, 复制的文件数)
+    """
+    linkNum = 0
+    copyNum = 0
+    canLink = True
+    for root, _, fileNames in os.walk(srcDir):
+        dstRoot = pathlib.Path(dstDir) / os.path.relpath(root, srcDir)
+        dstRoot.mkdir(parents=True, exist_ok=True)
+        for fileName in fileNames:
+            srcPath = os.path.join(root, fileName)
+            dstPath = dstRoot / fileName
+            if dstPath.exists() or dstPath.is_symlink():
+                dstPath.unlink()
+
+            if canLink:
+                try:
+                    os.link(srcPath, dstPath)
+                    linkNum += 1
+                    continue
+                except OSError as e:
+                    # 跨卷时后面的文件也不可能链接成功，其它错误只对当前文件复制
+                    if e.errno == errno.EXDEV or getattr(e, "winerror", None) == 17:
+                        canLink = False
+
+            shutil.copy2(srcPath, dstPath)
+            copyNum += 1
+    return linkNum, copyNum
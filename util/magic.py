@@ -150,6 +150,28 @@ def from_buffer(buffer, mime=False):
     return m.from_buffer(buffer)
 
 
+_thread_local = threading.local()
+
+
+def _get_thread_magic_type(mime):
+    instances = getattr(_thread_local, "instances", None)
+    if instances is None:
+        instances = _thread_local.instances = {}
+    i = instances.get(mime)
+    if i is None:
+        i = instances[mime] = Magic(mime=mime)
+    return i
+
+
+def from_buffer_concurrent(buffer, mime=False):
+    """
+    Same as from_buffer, but every thread uses its own Magic instance
+    (and libmagic cookie), so threads never wait on each other's lock.
+    """
+    m = _get_thread_magic_type(mime)
+    return m.from_buffer(buffer)
+
+
 libmagic = None
 # Let's try to find magic or magic1
 dll = ctypes.util.find_library('magic') or ctypes.util.find_library('magic1') or ctypes.util.find_library('cygmagic-1')
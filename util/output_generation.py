@@ -0,0 +1,161 @@
+"""
+每次导出写入一个新的代目录，全部成功后再替换正式的输出目录；旧的输出目录在后台线程中删除。导出失败时上一次成功的导出保持不变。
+"""
+
+import os
+import pathlib
+import shutil
+import threading
+import time
+from os import PathLike
+
+from util import log
+from util.file_sync import SyncManifest, MANIFEST_NAME
+
+DELETE_BATCH_SIZE = 200  # 后台删除时每删除这么多文件让出一次CPU
+
+_deletingSet = set()  # 正在后台删除的目录
+_deletingLock = threading.Lock()
+
+
+class OutputGeneration:
+    def __init__(self, outputDir: PathLike, uid: str, incremental=False):
+        """
+        :param outputDir: 输出根目录，代目录与正式的输出目录在同一个目录下，可以直接重命名
+        :param incremental: 增量导出时，用硬链接把上一次导出中同步清单记录的用户文件放入新的代目录，只同步变化的文件
+        """
+        self.rootPath = pathlib.Path(outputDir)
+        self.uid = uid
+        self.finalPath = self.rootPath / uid  # 正式的输出目录
+        self.path = self.rootPath / f".{uid}.gen-{time.time_ns()}"  # 本次导出写入的目录
+        self.incremental = incremental
+
+        self.lock = threading.Lock()
+        self.created = False
+
+    def create(self):
+        """
+        创建代目录，可以重复调用，只有第一次生效；解密线程和序列化线程都会调用，后调用的等待创建完成
+        """
+        with self.lock:
+            if self.created:
+                return
+            self.created = True
+
+            self.__deleteStale()
+            self.path.mkdir(parents=True, exist_ok=True)
+            if self.incremental:
+                self.__seedFromFinal()
+
+    def commit(self) -> bool:
+        """
+        用代目录替换正式的输出目录，旧的输出目录在后台删除。
+        两次重命名之间正式目录短暂不存在；第二次重命名失败时恢复旧的输出目录。
+        :return: 是否替换成功，失败时本次导出保留在self.path，见__keep
+        """
+        oldPath = self.rootPath / f".{self.uid}.old-{time.time_ns()}"
+        try:
+            if self.finalPath.exists():
+                os.rename(self.finalPath, oldPath)
+        except OSError as e:
+            log.e(f"无法移走{self.finalPath}: {e}")
+            self.__keep()
+            return False
+
+        try:
+            os.rename(self.path, self.finalPath)
+        except OSError as e:
+            log.e(f"无法将{self.path}重命名为{self.finalPath}: {e}")
+            if oldPath.exists():
+                os.rename(oldPath, self.finalPath)
+            self.__keep()
+            return False
+
+        if oldPath.exists():
+            deleteInBackground(oldPath)
+        return True
+
+    def discard(self):
+        """
+        导出失败时在后台删除代目录，正式的输出目录不变
+        """
+        if self.path.exists():
+            deleteInBackground(self.path)
+
+    def __keep(self):
+        """
+        替换失败时把代目录重命名为不以.开头的{uid}.export-*，下次导出不会把它当作残留的代目录删除
+        """
+        keptPath = self.rootPath / f"{self.uid}.export-{time.strftime('%Y%m%d-%H%M%S')}"
+        try:
+            os.rename(self.path, keptPath)
+            self.path = keptPath
+        except OSError as e:
+            log.e(f"无法将{self.path}重命名为{keptPath}: {e}")
+
+    def __deleteStale(self):
+        # 上次程序退出时没有删除完的代目录
+        for stalePath in self.rootPath.glob(f".{self.uid}.*"):
+            if stalePath != self.path and stalePath.is_dir() and \
+                    (stalePath.name.startswith(f".{self.uid}.gen-") or stalePath.name.startswith(f".{self.uid}.old-")):
+                deleteInBackground(stalePath)
+
+    def __seedFromFinal(self):
+        """
+        只链接同步清单中的文件。这些文件被改写前会先删除（见SyncManifest.syncTree和DatDecoder.decodeFile），
+        不会通过硬链接改写上一次的导出；清单本身会被改写，所以复制。
+        """
+        manifestPath = self.finalPath / MANIFEST_NAME
+        if not manifestPath.exists():
+            return
+
+        start = time.perf_counter()
+        linkNum = 0
+        for relativePath in SyncManifest(self.finalPath).entryDict:
+            srcPath = self.finalPath / relativePath
+            dstPath = self.path / relativePath
+            if not srcPath.is_file():
+                continue
+            dstPath.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(srcPath, dstPath)
+            except OSError:
+                shutil.copy2(srcPath, dstPath)
+            linkNum += 1
+        shutil.copy2(manifestPath, self.path / MANIFEST_NAME)
+        log.i(f"从{self.finalPath}链接{linkNum}个文件，耗时{time.perf_counter() - start:.3f}s")
+
+
+def deleteInBackground(path: PathLike):
+    """
+    在后台线程中删除目录，不阻塞界面和导出；程序退出时没删除完的部分在下次创建代目录时继续删除
+    """
+    path = pathlib.Path(path)
+    with _deletingLock:
+        if path in _deletingSet:
+            return
+        _deletingSet.add(path)
+    thread = threading.Thread(target=_deleteTree, args=(path,), name=f"delete {path}", daemon=True)
+    thread.start()
+
+
+def _deleteTree(path: pathlib.Path):
+    start = time.perf_counter()
+    fileNum = 0
+    for root, _, fileNames in os.walk(path, topdown=False):
+        for fileName in fileNames:
+            try:
+                os.remove(os.path.join(root, fileName))
+            except OSError:
+                pass
+            fileNum += 1
+            # 降低对正在进行的导出的影响
+            if fileNum % DELETE_BATCH_SIZE == 0:
+                time.sleep(0.01)
+        try:
+            os.rmdir(root)
+        except OSError:
+            pass
+    with _deletingLock:
+        _deletingSet.discard(path)
+    log.i(f"删除{path}: {fileNum}个文件，耗时{time.perf_counter() - start:.3f}s")
@@ -0,0 +1,69 @@
+"""
+把互相独立的会话分片交给线程池或进程池处理：结果按提交顺序返回，单个分片出错不影响其它分片，进度汇总后通过callback报告。
+"""
+
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from typing import Callable, Iterable, List, Tuple, Any, Deque
+
+from util import log
+
+
+class ShardRunner:
+    def __init__(self, workers: int = 1, useProcess=False, callback: Callable[[bool, str], None] = None):
+        """
+        :param workers: 并行的分片数，1为在当前线程依次处理
+        :param useProcess: 使用进程池，分片函数必须定义在模块顶层，参数和返回值必须可以pickle
+        :param callback: 与AppSerializer.callback相同，只在调用run的线程中调用
+        """
+        self.workers = workers
+        self.useProcess = useProcess
+        self.callback = callback
+        self.errorList: List[Tuple[Any, str]] = []  # [(分片key, 错误信息)]
+
+    def run(self, shardIter: Iterable[Tuple[Any, tuple]], func: Callable, prompt: str, total=0) -> List:
+        """
+        对每个分片(key, args)执行func(*args)，按shardIter的顺序返回结果，出错的分片结果为None并记录到errorList。
+        在途的分片不超过workers * 2个，shardIter可以是逐个读取会话的生成器。
+        :param prompt: 进度提示，后面加上"已完成数/总数"，total为0时只显示已完成数
+        """
+        resultList = []
+        if self.workers <= 1:
+            for key, args in shardIter:
+                try:
+                    result = func(*args)
+                except Exception as e:
+                    result = self.__onError(key, e)
+                resultList.append(result)
+                self.__onProgress(prompt, len(resultList), total)
+            return resultList
+
+        shardIter = iter(shardIter)
+        executorClass = ProcessPoolExecutor if self.useProcess else ThreadPoolExecutor
+        with executorClass(self.workers) as executor:
+            futureQueue: Deque[Tuple[Any, Future]] = deque(
+                (key, executor.submit(func, *args)) for key, args in itertools.islice(shardIter, self.workers * 2))
+            while len(futureQueue) != 0:
+                key, future = futureQueue.popleft()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = self.__onError(key, e)
+                resultList.append(result)
+                self.__onProgress(prompt, len(resultList), total)
+
+                nextShard = next(shardIter, None)
+                if nextShard is not None:
+                    futureQueue.append((nextShard[0], executor.submit(func, *nextShard[1])))
+        return resultList
+
+    def __onError(self, key, e: Exception):
+        log.e(f"分片{key}处理失败: {e!r}")
+        self.errorList.append((key, repr(e)))
+        return None
+
+    def __onProgress(self, prompt: str, doneNum: int, total: int):
+        if self.callback is None:
+            return
+        self.callback(False, f"{prompt}{doneNum}/{total}" if total > 0 else f"{prompt}{doneNum}")
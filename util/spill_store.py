@@ -0,0 +1,94 @@
+"""
+按key分组保存数据。内存中的数据超过预算时写入临时的SQLite数据库，读取某一组时再与内存中的数据按加入顺序合并。
+"""
+
+import os
+import pickle
+import sqlite3
+import tempfile
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Union
+
+
+class SpillGroupStore:
+    def __init__(self, memoryBudget: int = 0, sizeOf: Callable[[Any], int] = None):
+        """
+        :param memoryBudget: 内存中数据的大致字节数上限，0为不限制，不会写入磁盘
+        :param sizeOf: 估算一项数据所占字节数的函数
+        """
+        self.memoryBudget = memoryBudget
+        self.sizeOf = sizeOf if sizeOf is not None else (lambda item: 1)
+
+        self.groupDict: Dict[Any, List] = {}  # 还在内存中的数据 {key: [item]}
+        self.keyList: List = []  # 所有key，按第一次加入的顺序
+        self.keySet = set()
+        self.memorySize = 0
+
+        self.spillPath: Union[str, None] = None
+        self.spillConn: Union[sqlite3.Connection, None] = None
+        self.spillIndexed = False
+
+    def add(self, key, item):
+        if key not in self.keySet:
+            self.keySet.add(key)
+            self.keyList.append(key)
+        if key not in self.groupDict:
+            self.groupDict[key] = []
+
+        self.groupDict[key].append(item)
+        self.memorySize += self.sizeOf(item)
+        if 0 < self.memoryBudget < self.memorySize:
+            self.__spill()
+
+    def get(self, key) -> List:
+        """
+        返回key对应的全部数据，先写入磁盘的在前
+        """
+        result = []
+        if self.spillConn is not None:
+            if not self.spillIndexed:
+                self.spillConn.execute("create index spill_key_index on spill(groupKey, seq)")
+                self.spillIndexed = True
+            for data in self.spillConn.execute("select data from spill where groupKey = ? order by seq", (key,)):
+                result.append(pickle.loads(data[0]))
+        result.extend(self.groupDict.get(key, []))
+        return result
+
+    def items(self) -> Iterator[Tuple[Any, List]]:
+        """
+        按key第一次加入的顺序，每次只在内存中合并一组
+        """
+        for key in self.keyList:
+            yield key, self.get(key)
+
+    def keys(self) -> List:
+        return list(self.keyList)
+
+    def __contains__(self, key):
+        return key in self.keySet
+
+    def __len__(self):
+        return len(self.keyList)
+
+    def close(self):
+        if self.spillConn is not None:
+            self.spillConn.close()
+            self.spillConn = None
+            os.remove(self.spillPath)
+        self.groupDict.clear()
+        self.memorySize = 0
+
+    def __spill(self):
+        if self.spillConn is None:
+            fd, self.spillPath = tempfile.mkstemp(suffix=".db", prefix="spill_")
+            os.close(fd)
+            self.spillConn = sqlite3.connect(self.spillPath, check_same_thread=False)
+            self.spillConn.execute("pragma journal_mode = off")
+            self.spillConn.execute("pragma synchronous = off")
+            self.spillConn.execute("create table spill(seq integer primary key, groupKey, data blob)")
+
+        self.spillConn.executemany("insert into spill(groupKey, data) values (?, ?)",
+                                   ((key, pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+                                    for key, itemList in self.groupDict.items() for item in itemList))
+        self.spillConn.commit()
+        self.groupDict.clear()
+        self.memorySize = 0
@@ -1,11 +1,12 @@
 import hashlib
 import json
 import mimetypes
+import mmap
 import os
 import pathlib
 import time
 from os import PathLike
-from typing import Dict, Tuple, AnyStr, Any, List
+from typing import Dict, Tuple, AnyStr, Any, List, BinaryIO, Union
 
 from PyQt5 import QtGui
 from PyQt5.QtCore import QSize, QFile, Qt
@@ -20,15 +21,50 @@ from util.cpp_lib import CppLibrary
 
 log.i(resources.resources_rc.qt_version)
 
-fileHeaderBytesDict = {
-    # "ffd8": ".jpeg",
-    # "8950": ".png",
-    # "4749": ".gif",
-    # "504b": ".zip",
-    # "2550": ".pdf",
-    # "0000": ".mp4",
-    "0223": ".slk"
-}
+SNIFF_HEADER_SIZE = 8192  # 判断文件类型时读取的文件头长度
+
+# 文件签名表，每项为([(offset, 签名字节)...], 后缀)，所有签名都匹配才认为是该类型，靠前的优先。
+# zip和doc等复合格式需要libmagic区分docx、xlsx、apk等，不在表中。
+fileSignatureList = [
+    ([(0, b"\xff\xd8\xff")], ".jpg"),
+    ([(0, b"\x89PNG\r\n\x1a\n")], ".png"),
+    ([(0, b"GIF87a")], ".gif"),
+    ([(0, b"GIF89a")], ".gif"),
+    ([(0, b"RIFF"), (8, b"WEBP")], ".webp"),
+    ([(0, b"II*\x00")], ".tiff"),
+    ([(0, b"MM\x00*")], ".tiff"),
+    ([(4, b"ftypqt")], ".mov"),
+    ([(4, b"ftypM4A")], ".m4a"),
+    ([(4, b"ftyp3g")], ".3gp"),
+    # 只列出mp4的brand，heic、avif、m4v等同样以ftyp开头的格式交给libmagic
+    ([(4, b"ftypisom")], ".mp4"),
+    ([(4, b"ftypiso2")], ".mp4"),
+    ([(4, b"ftypiso4")], ".mp4"),
+    ([(4, b"ftypiso5")], ".mp4"),
+    ([(4, b"ftypiso6")], ".mp4"),
+    ([(4, b"ftypmp41")], ".mp4"),
+    ([(4, b"ftypmp42")], ".mp4"),
+    ([(4, b"ftypavc1")], ".mp4"),
+    ([(4, b"ftypdash")], ".mp4"),
+    ([(4, b"ftypMSNV")], ".mp4"),
+    ([(4, b"ftypmmp4")], ".mp4"),
+    ([(0, b"RIFF"), (8, b"AVI ")], ".avi"),
+    ([(0, b"RIFF"), (8, b"WAVE")], ".wav"),
+    ([(0, b"\x1aE\xdf\xa3")], ".mkv"),
+    ([(0, b"FLV")], ".flv"),
+    ([(0, b"ID3")], ".mp3"),
+    ([(0, b"OggS")], ".ogg"),
+    ([(0, b"fLaC")], ".flac"),
+    ([(0, b"#!AMR")], ".amr"),
+    ([(0, b"#!SILK")], ".slk"),
+    ([(0, b"\x02#")], ".slk"),  # 微信语音
+    ([(0, b"%PDF")], ".pdf"),
+    ([(0, b"Rar!\x1a\x07")], ".rar"),
+    ([(0, b"7z\xbc\xaf\x27\x1c")], ".7z"),
+    ([(0, b"\x1f\x8b")], ".gz"),
+    ([(0, b"BZh")], ".bz2"),
+    ([(0, b"\xfd7zXZ\x00")], ".xz"),
+]
 
 
 class UITool:
@@ -225,13 +261,23 @@ class Utility:
         return json.dumps(obj, ensure_ascii=False, indent=4)
 
     @staticmethod
-    def getFileExtByBytes(fileBytes: bytes) -> str:
-        mime = magic.from_buffer(fileBytes, mime=True)
-
-        if mime == "application/octet-stream":
-            if fileBytes[0:2].hex() in fileHeaderBytesDict:
-                return fileHeaderBytesDict[fileBytes[0:2].hex()]
+    def getFileExtBySignature(header: bytes) -> Union[str, None]:
+        for signatureList, ext in fileSignatureList:
+            if all(header[offset:offset + len(signature)] == signature for offset, signature in signatureList):
+                return ext
+        return None
 
+    @staticmethod
+    def getFileExtByBytes(fileBytes: bytes) -> str:
+        """
+        先用文件签名表匹配文件头，都不匹配时再使用libmagic，最多只传入SNIFF_HEADER_SIZE个字节
+        """
+        header = bytes(fileBytes[0:SNIFF_HEADER_SIZE])
+        ext = Utility.getFileExtBySignature(header)
+        if ext is not None:
+            return ext
+
+        mime = magic.from_buffer_concurrent(header, mime=True)
         ext = mimetypes.guess_extension(mime)
         if ext is None:
             ext = ""
@@ -253,6 +299,43 @@ class Utility:
             content = fr.read(length)
         return content
 
+    @staticmethod
+    def copyFileRange(fr: BinaryIO, fw: BinaryIO, offset: int, length: int, buffer: bytearray):
+        """
+        把fr中[offset, offset + length)的内容复制到fw的当前位置。
+        优先使用copy_file_range或sendfile在内核中复制，不支持时使用可复用的buffer分块读写。
+        """
+        fw.flush()
+        srcFd = fr.fileno()
+        dstFd = fw.fileno()
+
+        for kernelCopy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+            if kernelCopy is None:
+                continue
+            try:
+                while length > 0:
+                    if kernelCopy is os.sendfile:
+                        copied = os.sendfile(dstFd, srcFd, offset, length)
+                    else:
+                        copied = os.copy_file_range(srcFd, dstFd, length, offset)
+                    if copied == 0:  # 已到文件末尾
+                        return
+                    offset += copied
+                    length -= copied
+                return
+            except OSError:  # 不支持的文件系统或平台，使用下一种方式复制剩余部分
+                continue
+
+        bufferView = memoryview(buffer)
+        fr.seek(offset, 0)
+        while length > 0:
+            readLen = fr.readinto(bufferView[0:min(len(buffer), length)])
+            if readLen == 0:
+                break
+            fw.write(bufferView[0:readLen])
+            length -= readLen
+        bufferView.release()
+
     @staticmethod
     def writeFile(outputPath: PathLike, content: AnyStr, autoExt=False):
 
@@ -286,6 +369,66 @@ class Utility:
         return time.time() * 1000
 
 
+class JsonListWriter:
+    def __init__(self, path: PathLike, encoding="utf-8", errors="strict"):
+        """
+        逐个元素写入Json数组，写完后的文件与Utility.getJsonStr(list)的结果完全一致。
+        """
+        self.file = open(path, "w", encoding=encoding, errors=errors)
+        self.count = 0
+
+    def append(self, obj):
+        # 数组元素整体缩进一级；字符串中的换行已被转义，所以可以直接替换
+        elemStr = Utility.getJsonStr(obj).replace("\n", "\n    ")
+        self.file.write(("[\n    " if self.count == 0 else ",\n    ") + elemStr)
+        self.count += 1
+
+    def close(self):
+        self.file.write("\n]" if self.count != 0 else "[]")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excVal, excTb):
+        self.close()
+
+
+class MappedFileReader:
+    def __init__(self):
+        """
+        每个文件只打开并mmap一次，按(offset, length)返回零拷贝的memoryview。
+        返回的memoryview用完后需要release()，否则close时无法解除映射。
+        """
+        self.fileDict: Dict[str, Tuple[BinaryIO, Union[mmap.mmap, None], memoryview]] = {}
+
+    def read(self, filePath: PathLike, offset: int, length: int) -> memoryview:
+        key = str(filePath)
+        if key not in self.fileDict:
+            fr = open(key, 'rb')
+            if os.fstat(fr.fileno()).st_size == 0:  # 空文件无法mmap
+                self.fileDict[key] = (fr, None, memoryview(b""))
+            else:
+                mm = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ)
+                self.fileDict[key] = (fr, mm, memoryview(mm))
+
+        return self.fileDict[key][2][offset:offset + length]
+
+    def close(self):
+        for fr, mm, view in self.fileDict.values():
+            view.release()
+            if mm is not None:
+                mm.close()
+            fr.close()
+        self.fileDict.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excVal, excTb):
+        self.close()
+
+
 if __name__ == '__main__':
     import win32api
     import win32con